@@ -0,0 +1,136 @@
+"""Capture of the incoming messages and the timings of their handling for later replays"""
+import logging
+import logging.handlers
+import pathlib
+import threading
+import time
+import typing
+
+import ujson
+
+_logger = logging.getLogger(__name__)
+
+
+class Recorder:
+    """
+    A recorder writing one JSON line per incoming message into a rotating capture file
+
+    Every line contains the time at which the message was received, the message body, whether
+    the message was accepted by the content validator, the number of seconds spent in the
+    validator and the executor, the size of the reply and the name of the error raised by the
+    executor. The consumer of the ``amqp_rpc_server`` package calls the content validator and the
+    executor for a message on the same thread, so the timings of the validator are kept in a
+    thread-local storage until the executor has finished
+    """
+
+    def __init__(self, file: pathlib.Path, max_bytes: int, backup_count: int):
+        file.parent.mkdir(parents=True, exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(
+            file, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8"
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self._capture_logger = logging.getLogger(f"{__name__}.{file}")
+        self._capture_logger.handlers = [handler]
+        self._capture_logger.setLevel(logging.INFO)
+        self._capture_logger.propagate = False
+        self._validations = threading.local()
+
+    def wrap(
+        self,
+        content_validator: typing.Callable[[bytes], bool],
+        executor: typing.Callable[[bytes], bytes],
+    ) -> tuple[typing.Callable[[bytes], bool], typing.Callable[[bytes], bytes]]:
+        """
+        Wrap the content validator and the executor to capture the messages passed to them
+
+        :param content_validator: The content validator which shall be wrapped
+        :param executor: The executor which shall be wrapped
+        :return: The wrapped content validator and executor
+        """
+
+        def captured_content_validator(message: bytes) -> bool:
+            received = time.time()
+            validation_start = time.perf_counter()
+            valid = content_validator(message)
+            validation_time = time.perf_counter() - validation_start
+            if valid:
+                self._validations.received = received
+                self._validations.validation_time = validation_time
+            else:
+                self._write(message, received, False, validation_time)
+            return valid
+
+        def captured_executor(message: bytes) -> bytes:
+            received = getattr(self._validations, "received", None) or time.time()
+            validation_time = getattr(self._validations, "validation_time", None)
+            self._validations.received = None
+            self._validations.validation_time = None
+            execution_start = time.perf_counter()
+            try:
+                reply = executor(message)
+            except Exception as execution_error:
+                execution_time = time.perf_counter() - execution_start
+                self._write(
+                    message,
+                    received,
+                    True,
+                    validation_time,
+                    execution_time,
+                    error=type(execution_error).__name__,
+                )
+                raise
+            execution_time = time.perf_counter() - execution_start
+            self._write(message, received, True, validation_time, execution_time, len(reply))
+            return reply
+
+        return captured_content_validator, captured_executor
+
+    def _write(
+        self,
+        message: bytes,
+        received: float,
+        valid: bool,
+        validation_time: typing.Optional[float],
+        execution_time: typing.Optional[float] = None,
+        reply_size: int = 0,
+        error: typing.Optional[str] = None,
+    ) -> None:
+        try:
+            self._capture_logger.info(
+                ujson.dumps(
+                    {
+                        "timestamp": received,
+                        "body": message.decode("utf-8", errors="replace"),
+                        "valid": valid,
+                        "validationTime": validation_time,
+                        "executionTime": execution_time,
+                        "replySize": reply_size,
+                        "error": error,
+                    },
+                    ensure_ascii=False,
+                )
+            )
+        except Exception as capture_error:
+            _logger.warning("Unable to capture a message", exc_info=capture_error)
+
+
+def read(file: pathlib.Path) -> list[dict]:
+    """
+    Read the captured messages from the capture file and its rotated backups
+
+    :param file: The capture file
+    :return: The captured messages ordered by the time at which they were received
+    """
+    backups = sorted(
+        (backup for backup in file.parent.glob(f"{file.name}.*") if backup.suffix[1:].isdigit()),
+        key=lambda backup: int(backup.suffix[1:]),
+        reverse=True,
+    )
+    records = []
+    for capture_file in [*backups, file]:
+        if not capture_file.is_file():
+            continue
+        with open(capture_file, "r", encoding="utf-8") as capture:
+            records.extend(ujson.loads(line) for line in capture if line.strip())
+    records.sort(key=lambda record: record["timestamp"])
+    return records
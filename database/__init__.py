@@ -1,6 +1,10 @@
 import logging
+import threading
+import time
 
 import sqlalchemy.engine
+import sqlalchemy.exc
+import sqlalchemy.pool
 
 import settings
 
@@ -8,4 +12,83 @@ _logger = logging.getLogger(__name__)
 
 _settings = settings.DatabaseSettings()
 
-engine = sqlalchemy.engine.create_engine(_settings.dsn, pool_recycle=90)
+
+class MeteredQueuePool(sqlalchemy.pool.QueuePool):
+    """
+    A queue pool which records how often connections are checked out and how long the threads
+    had to wait for them
+
+    The queue pool retries a checkout by calling ``_do_get`` again if it loses a race for a free
+    slot, so only the outermost call of a thread is recorded
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._statistics_lock = threading.Lock()
+        self._checkout_state = threading.local()
+        self._checkouts = 0
+        self._timeouts = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+
+    def _do_get(self):
+        if getattr(self._checkout_state, "active", False):
+            return super()._do_get()
+        self._checkout_state.active = True
+        wait_start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except sqlalchemy.exc.TimeoutError:
+            with self._statistics_lock:
+                self._timeouts += 1
+            raise
+        finally:
+            self._checkout_state.active = False
+            wait_time = time.perf_counter() - wait_start
+            with self._statistics_lock:
+                self._checkouts += 1
+                self._wait_time += wait_time
+                self._max_wait_time = max(self._max_wait_time, wait_time)
+
+    def statistics(self) -> dict:
+        """
+        Get the statistics of the pool
+
+        :return: The number of checkouts and timeouts, the total, mean and maximal wait time in
+            seconds and the current state of the pool
+        """
+        with self._statistics_lock:
+            return {
+                "checkouts": self._checkouts,
+                "timeouts": self._timeouts,
+                "waitTime": self._wait_time,
+                "meanWaitTime": self._wait_time / self._checkouts if self._checkouts else 0.0,
+                "maxWaitTime": self._max_wait_time,
+                "checkedOut": self.checkedout(),
+                "overflow": max(self.overflow(), 0),
+                "size": self.size(),
+            }
+
+
+engine = sqlalchemy.engine.create_engine(
+    _settings.dsn,
+    poolclass=MeteredQueuePool,
+    pool_size=_settings.pool_size,
+    max_overflow=_settings.pool_max_overflow,
+    pool_timeout=_settings.pool_timeout,
+    pool_recycle=_settings.pool_recycle,
+    pool_pre_ping=_settings.pool_pre_ping,
+    query_cache_size=_settings.query_cache_size,
+)
+
+
+def pool_statistics() -> dict:
+    """
+    Get the statistics of the connection pool used by the engine
+
+    :return: The statistics of the connection pool or an empty mapping if the engine uses a
+        different pool
+    """
+    if not isinstance(engine.pool, MeteredQueuePool):
+        return {}
+    return engine.pool.statistics()
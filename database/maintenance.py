@@ -0,0 +1,181 @@
+"""Management of the indexes and the yearly rollup used by the service"""
+import argparse
+import datetime
+import logging
+import typing
+
+import sqlalchemy
+import sqlalchemy.dialects.postgresql
+import sqlalchemy.engine
+from sqlalchemy.sql import select
+from sqlalchemy.sql.functions import sum as sum_
+
+import database
+import database.tables
+
+_logger = logging.getLogger(__name__)
+
+_ROLLUP_LOCK_ID = 0x7761746572
+"""The id of the advisory lock serializing the refreshes of the yearly rollup"""
+
+_ROLLUP_TABLES = (database.tables.usages_yearly, database.tables.usages_yearly_state)
+"""The tables holding the yearly rollup and the state of its refreshes"""
+
+
+def ensure_performance_objects():
+    """
+    Check if the indexes and the yearly rollup table exist and create the missing ones
+    """
+    inspector = sqlalchemy.inspect(database.engine)
+    for table in _ROLLUP_TABLES:
+        if not inspector.has_table(table.name, schema=table.schema):
+            _logger.info("Creating the table %s.%s", table.schema, table.name)
+            table.create(bind=database.engine)
+    for index in (
+        database.tables.usages_lookup_index,
+        database.tables.usages_recorded_at_index,
+        database.tables.shapes_key_prefix_index,
+    ):
+        existing_indexes = inspector.get_indexes(index.table.name, schema=index.table.schema)
+        if index.name not in [existing_index["name"] for existing_index in existing_indexes]:
+            _logger.info("Creating the index %s", index.name)
+            index.create(bind=database.engine)
+
+
+def rollup_tables_exist() -> bool:
+    """Check if the yearly rollup table and the table holding the state of its refreshes exist"""
+    inspector = sqlalchemy.inspect(database.engine)
+    return all(inspector.has_table(table.name, schema=table.schema) for table in _ROLLUP_TABLES)
+
+
+def backfill_recording_times(connection: sqlalchemy.engine.Connection) -> int:
+    """
+    Set the recording time of the usages without one to the time of the current transaction
+
+    The backfilled usages are picked up like usages recorded right now, so they are included by
+    the rebuild running the backfill and by the next incremental refresh of every other rollup
+    and snapshot
+
+    :param connection: The connection whose transaction backfills the usages
+    :return: The number of backfilled usages
+    """
+    usages = database.tables.usages
+    backfilled_usages = connection.execute(
+        usages.update()
+        .where(usages.c.recorded_at.is_(None))
+        .values(recorded_at=sqlalchemy.func.now())
+    ).rowcount
+    if backfilled_usages:
+        _logger.info("Backfilled the recording time of %s usages", backfilled_usages)
+    return backfilled_usages
+
+
+def read_recording_bound(
+    connection: sqlalchemy.engine.Connection,
+) -> typing.Optional[datetime.datetime]:
+    """
+    Get the latest ``recorded_at`` timestamp of the usages
+
+    The lookup is answered from the index on ``recorded_at``. Usages without a recording time are
+    counted and reported, since they are only included once a rebuild has backfilled them
+
+    :param connection: The connection used to query the usages
+    :return: The latest recording time or ``None`` if no usage has a recording time
+    """
+    usages = database.tables.usages
+    unrecorded_usages = connection.execute(
+        select([sqlalchemy.func.count()]).where(usages.c.recorded_at.is_(None))
+    ).scalar()
+    if unrecorded_usages:
+        _logger.warning(
+            "%s usages have no recording time and are only included in the yearly sums after "
+            "a rebuild has backfilled their recording time",
+            unrecorded_usages,
+        )
+    return connection.execute(select([sqlalchemy.func.max(usages.c.recorded_at)])).scalar()
+
+
+def recorded_usages_filter(
+    watermark: typing.Optional[datetime.datetime], upper_bound: datetime.datetime
+) -> sqlalchemy.sql.ColumnElement:
+    """
+    Get the filter selecting the usages recorded after the watermark up to the upper bound
+
+    Usages without a recording time never match the filter, they are backfilled by a rebuild.
+    Usages which are committed after a refresh with a recording time before its watermark are only
+    included by a rebuild
+
+    :param watermark: The latest recording time already contained in the yearly sums
+    :param upper_bound: The latest recording time which shall be included
+    :return: The filter on the usages table
+    """
+    usages = database.tables.usages
+    recorded_filter = usages.c.recorded_at <= upper_bound
+    if watermark is not None:
+        recorded_filter = sqlalchemy.and_(usages.c.recorded_at > watermark, recorded_filter)
+    return recorded_filter
+
+
+def refresh_yearly_usages(rebuild: bool = False):
+    """
+    Add the usages recorded since the last refresh onto the yearly rollup
+
+    The usages recorded after the watermark stored in the state table are summed up per
+    municipal, usage type and year and added onto the existing rows of the rollup. The refresh
+    runs in a single transaction holding an advisory lock, so multiple instances may refresh the
+    rollup without counting usages twice
+
+    :param rebuild: Whether the recording times of the usages without one are backfilled and the
+        rollup is cleared and recalculated from all usages
+    """
+    usages = database.tables.usages
+    usages_yearly = database.tables.usages_yearly
+    state = database.tables.usages_yearly_state
+    with database.engine.begin() as connection:
+        connection.execute(
+            sqlalchemy.select([sqlalchemy.func.pg_advisory_xact_lock(_ROLLUP_LOCK_ID)])
+        )
+        if rebuild:
+            _logger.info("Rebuilding the yearly rollup")
+            backfill_recording_times(connection)
+            connection.execute(usages_yearly.delete())
+            connection.execute(state.delete())
+        watermark = connection.execute(select([state.c.watermark])).scalar()
+        upper_bound = read_recording_bound(connection)
+        if upper_bound is None or (watermark is not None and upper_bound <= watermark):
+            _logger.info("The yearly rollup is up to date")
+            return
+        year = sqlalchemy.cast(sqlalchemy.extract("year", usages.c.date), sqlalchemy.Integer)
+        delta_query = select(
+            [usages.c.municipality, usages.c.usage_type, year, sum_(usages.c.amount)],
+            recorded_usages_filter(watermark, upper_bound),
+        ).group_by(usages.c.municipality, usages.c.usage_type, year)
+        insert_statement = sqlalchemy.dialects.postgresql.insert(usages_yearly).from_select(
+            ["municipality", "usage_type", "year", "amount"], delta_query
+        )
+        connection.execute(
+            insert_statement.on_conflict_do_update(
+                index_elements=["municipality", "usage_type", "year"],
+                set_={"amount": usages_yearly.c.amount + insert_statement.excluded.amount},
+            )
+        )
+        if watermark is None:
+            connection.execute(state.insert().values(id=1, watermark=upper_bound))
+        else:
+            connection.execute(state.update().where(state.c.id == 1).values(watermark=upper_bound))
+        _logger.info("Refreshed the yearly rollup with the usages recorded until %s", upper_bound)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="backfill missing recording times and recalculate the yearly rollup from all usages",
+    )
+    arguments = parser.parse_args()
+    logging.basicConfig(
+        format="%(levelname)s | %(asctime)s | %(name)s | %(message)s", level=logging.INFO
+    )
+    ensure_performance_objects()
+    refresh_yearly_usages(rebuild=arguments.rebuild)
@@ -0,0 +1,302 @@
+"""Local memory-mapped snapshot of the yearly usage sums"""
+import argparse
+import contextlib
+import datetime
+import fcntl
+import logging
+import os
+import pathlib
+import shutil
+import threading
+import typing
+
+import numpy
+import sqlalchemy
+import ujson
+from sqlalchemy.sql import select
+from sqlalchemy.sql.functions import sum as sum_
+
+import database
+import database.maintenance
+import database.tables
+import series
+
+_logger = logging.getLogger(__name__)
+
+_CURRENT_FILE = "CURRENT"
+_LOCK_FILE = ".lock"
+_META_FILE = "meta.json"
+_ARRAYS = (
+    "municipals",
+    "usage_types",
+    "series_municipals",
+    "series_usage_types",
+    "series_offsets",
+    "years",
+    "amounts",
+)
+
+
+class Snapshot:
+    """
+    A read-only view onto one generation of the snapshot
+
+    The yearly usage sums are stored ordered by the municipal, the usage type and the year. The
+    municipal keys and usage type ids are dictionary-encoded and every series is described by
+    the codes of its municipal and usage type and its offset into the ``years`` and ``amounts``
+    arrays. All arrays are memory-mapped, therefore series read from the snapshot do not copy
+    any usage values
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        """The directory containing the arrays of this generation"""
+
+        with open(path / _META_FILE, "r") as meta_file:
+            meta = ujson.load(meta_file)
+        self.watermark: typing.Optional[datetime.datetime] = (
+            datetime.datetime.fromisoformat(meta["watermark"]) if meta["watermark"] else None
+        )
+        """The latest ``recorded_at`` timestamp contained in the snapshot"""
+
+        for name in _ARRAYS:
+            setattr(self, name, numpy.load(path / f"{name}.npy", mmap_mode="r"))
+
+    def read_series(
+        self, municipal_keys: typing.Iterable[str], usage_type_ids: typing.Iterable
+    ) -> list[series.UsageSeries]:
+        """
+        Read the usage series of the municipals and usage types from the snapshot
+
+        :param municipal_keys: The official municipal keys of the requested municipals
+        :param usage_type_ids: The database ids of the requested usage types
+        :return: The usage series which are present in the snapshot
+        """
+        usage_type_ids = {str(usage_type_id): usage_type_id for usage_type_id in usage_type_ids}
+        selection = numpy.isin(
+            self.series_municipals, _encode(self.municipals, list(municipal_keys))
+        ) & numpy.isin(self.series_usage_types, _encode(self.usage_types, list(usage_type_ids)))
+        usage_series = []
+        for index in numpy.flatnonzero(selection):
+            start, end = self.series_offsets[index], self.series_offsets[index + 1]
+            usage_series.append(
+                series.UsageSeries(
+                    municipal=str(self.municipals[self.series_municipals[index]]),
+                    consumer_group=usage_type_ids[
+                        str(self.usage_types[self.series_usage_types[index]])
+                    ],
+                    start_year=int(self.years[start]),
+                    end_year=int(self.years[end - 1]),
+                    reference=self.amounts[start:end],
+                )
+            )
+        return usage_series
+
+
+def _encode(dictionary: numpy.ndarray, values: list[str]) -> numpy.ndarray:
+    """
+    Get the codes of the values in a sorted dictionary and drop the values which are not present
+
+    :param dictionary: The sorted dictionary of the values
+    :param values: The values which shall be encoded
+    :return: The codes of the values
+    """
+    if len(dictionary) == 0 or len(values) == 0:
+        return numpy.empty(0, dtype=numpy.int64)
+    values = numpy.asarray(values, dtype=str)
+    codes = numpy.minimum(numpy.searchsorted(dictionary, values), len(dictionary) - 1)
+    return codes[dictionary[codes] == values]
+
+
+_snapshot_lock = threading.Lock()
+_snapshot: typing.Optional[Snapshot] = None
+
+
+def load(directory: pathlib.Path) -> typing.Optional[Snapshot]:
+    """
+    Get the current generation of the snapshot stored in the directory
+
+    The generation is reopened if another process published a newer one since the last call
+
+    :param directory: The directory in which the snapshot is stored
+    :return: The current generation or ``None`` if no snapshot has been synchronized yet
+    """
+    global _snapshot
+    generation = _read_current(directory)
+    if generation is None:
+        return None
+    with _snapshot_lock:
+        if _snapshot is None or _snapshot.path.name != generation:
+            _logger.info("Opening generation %s of the usage data snapshot", generation)
+            _snapshot = Snapshot(directory / generation)
+        return _snapshot
+
+
+@contextlib.contextmanager
+def _exclusive_lock(directory: pathlib.Path):
+    """Hold an exclusive lock on the snapshot directory to serialize synchronizations"""
+    with open(directory / _LOCK_FILE, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def synchronize(directory: pathlib.Path, rebuild: bool = False) -> None:
+    """
+    Synchronize the snapshot with the usages stored in the database
+
+    Only the usages recorded after the watermark of the current generation are pulled from the
+    database and added onto the existing yearly sums. The merged sums are written into a new
+    generation which replaces the current generation atomically. The usages are selected like
+    the ones of the yearly rollup, so usages without a recording time are only included once a
+    rebuild has backfilled their recording time and usages committed with a recording time before
+    the watermark are only included by a rebuild
+
+    :param directory: The directory in which the snapshot is stored
+    :param rebuild: Whether the recording times of the usages without one are backfilled and the
+        sums are recalculated from all usages
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    with _exclusive_lock(directory):
+        current = load(directory) if not rebuild else None
+        watermark = current.watermark if current is not None else None
+        with database.engine.begin() as connection:
+            if rebuild:
+                database.maintenance.backfill_recording_times(connection)
+            upper_bound = database.maintenance.read_recording_bound(connection)
+            if upper_bound is None or (watermark is not None and upper_bound <= watermark):
+                _logger.info("The usage data snapshot is up to date")
+                return
+            year = sqlalchemy.extract("year", database.tables.usages.c.date)
+            delta_query = select(
+                [
+                    database.tables.usages.c.municipality,
+                    database.tables.usages.c.usage_type,
+                    year,
+                    sum_(database.tables.usages.c.amount),
+                ],
+                database.maintenance.recorded_usages_filter(watermark, upper_bound),
+            ).group_by(
+                database.tables.usages.c.municipality,
+                database.tables.usages.c.usage_type,
+                year,
+            )
+            _logger.info("Pulling the usages recorded after %s until %s", watermark, upper_bound)
+            delta = connection.execute(delta_query).all()
+        if len(delta) == 0:
+            _logger.info("The usage data snapshot is up to date")
+            return
+        municipals, usage_types, years, amounts = zip(*delta)
+        municipals = numpy.array(municipals, dtype=str)
+        usage_types = numpy.array([str(usage_type) for usage_type in usage_types], dtype=str)
+        years = numpy.array(years, dtype=numpy.int16)
+        amounts = numpy.nan_to_num(numpy.array(amounts, dtype=numpy.float64))
+        if current is not None:
+            # %% Expand the current generation into rows and prepend them to the delta
+            lengths = numpy.diff(current.series_offsets)
+            municipals = numpy.concatenate(
+                (numpy.repeat(current.municipals[current.series_municipals], lengths), municipals)
+            )
+            usage_types = numpy.concatenate(
+                (
+                    numpy.repeat(current.usage_types[current.series_usage_types], lengths),
+                    usage_types,
+                )
+            )
+            years = numpy.concatenate((current.years, years))
+            amounts = numpy.concatenate((current.amounts, amounts))
+        _write_generation(directory, municipals, usage_types, years, amounts, upper_bound)
+
+
+def _write_generation(
+    directory: pathlib.Path,
+    municipals: numpy.ndarray,
+    usage_types: numpy.ndarray,
+    years: numpy.ndarray,
+    amounts: numpy.ndarray,
+    watermark: typing.Optional[datetime.datetime],
+) -> None:
+    """
+    Sum up the rows per municipal, usage type and year and publish them as a new generation
+
+    :param directory: The directory in which the snapshot is stored
+    :param municipals: The municipal key of every row
+    :param usage_types: The usage type id of every row
+    :param years: The year of every row
+    :param amounts: The usage amount of every row
+    :param watermark: The latest ``recorded_at`` timestamp contained in the rows
+    """
+    municipal_dictionary, municipal_codes = numpy.unique(municipals, return_inverse=True)
+    usage_type_dictionary, usage_type_codes = numpy.unique(usage_types, return_inverse=True)
+    order = numpy.lexsort((years, usage_type_codes, municipal_codes))
+    municipal_codes = municipal_codes[order].astype(numpy.int32)
+    usage_type_codes = usage_type_codes[order].astype(numpy.int32)
+    years = years[order]
+    amounts = amounts[order]
+    # %% Sum up the rows which share the municipal, the usage type and the year
+    row_changes = numpy.flatnonzero(
+        (municipal_codes[1:] != municipal_codes[:-1])
+        | (usage_type_codes[1:] != usage_type_codes[:-1])
+        | (years[1:] != years[:-1])
+    )
+    row_starts = numpy.concatenate(([0], row_changes + 1))
+    amounts = numpy.add.reduceat(amounts, row_starts)
+    municipal_codes = municipal_codes[row_starts]
+    usage_type_codes = usage_type_codes[row_starts]
+    years = years[row_starts]
+    # %% Describe the series by their codes and offsets
+    series_changes = numpy.flatnonzero(
+        (municipal_codes[1:] != municipal_codes[:-1])
+        | (usage_type_codes[1:] != usage_type_codes[:-1])
+    )
+    series_starts = numpy.concatenate(([0], series_changes + 1))
+    arrays = {
+        "municipals": municipal_dictionary,
+        "usage_types": usage_type_dictionary,
+        "series_municipals": municipal_codes[series_starts],
+        "series_usage_types": usage_type_codes[series_starts],
+        "series_offsets": numpy.append(series_starts, len(years)).astype(numpy.int64),
+        "years": years,
+        "amounts": amounts,
+    }
+    generation = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+    generation_path = directory / generation
+    generation_path.mkdir()
+    for name, array in arrays.items():
+        numpy.save(generation_path / f"{name}.npy", array)
+    with open(generation_path / _META_FILE, "w") as meta_file:
+        ujson.dump({"watermark": watermark.isoformat() if watermark else None}, meta_file)
+    # %% Publish the generation and remove the generations which are no longer needed
+    previous = _read_current(directory)
+    temporary_current_file = directory / f"{_CURRENT_FILE}.{generation}"
+    temporary_current_file.write_text(generation)
+    os.replace(temporary_current_file, directory / _CURRENT_FILE)
+    _logger.info("Published generation %s of the usage data snapshot", generation)
+    for path in directory.iterdir():
+        if path.is_dir() and path.name not in (generation, previous):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def _read_current(directory: pathlib.Path) -> typing.Optional[str]:
+    """Read the name of the currently published generation"""
+    try:
+        return (directory / _CURRENT_FILE).read_text().strip()
+    except FileNotFoundError:
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("directory", type=pathlib.Path, help="directory of the snapshot")
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="backfill missing recording times and recalculate the snapshot from all usages",
+    )
+    arguments = parser.parse_args()
+    logging.basicConfig(
+        format="%(levelname)s | %(asctime)s | %(name)s | %(message)s", level=logging.INFO
+    )
+    synchronize(arguments.directory, rebuild=arguments.rebuild)
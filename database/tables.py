@@ -21,6 +21,24 @@ usages = sqlalchemy.Table(
     sqlalchemy.Column("amount", sqlalchemy.dialects.postgresql.DOUBLE_PRECISION),
 )
 
+usages_yearly = sqlalchemy.Table(
+    "usages_yearly",
+    water_usage_meta_data,
+    sqlalchemy.Column("municipality", sqlalchemy.VARCHAR, primary_key=True),
+    sqlalchemy.Column(
+        "usage_type", sqlalchemy.dialects.postgresql.UUID(as_uuid=True), primary_key=True
+    ),
+    sqlalchemy.Column("year", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("amount", sqlalchemy.dialects.postgresql.DOUBLE_PRECISION),
+)
+
+usages_yearly_state = sqlalchemy.Table(
+    "usages_yearly_state",
+    water_usage_meta_data,
+    sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("watermark", sqlalchemy.TIMESTAMP),
+)
+
 usage_types = sqlalchemy.Table(
     "usage_types",
     water_usage_meta_data,
@@ -39,6 +57,24 @@ shapes = sqlalchemy.Table(
     sqlalchemy.Column("nuts_key", sqlalchemy.Text),
 )
 
+usages_lookup_index = sqlalchemy.Index(
+    "usages_municipality_usage_type_date_idx",
+    usages.c.municipality,
+    usages.c.usage_type,
+    usages.c.date,
+)
+
+usages_recorded_at_index = sqlalchemy.Index(
+    "usages_recorded_at_idx",
+    usages.c.recorded_at,
+)
+
+shapes_key_prefix_index = sqlalchemy.Index(
+    "shapes_key_prefix_idx",
+    shapes.c.key,
+    postgresql_ops={"key": "text_pattern_ops"},
+)
+
 
 def initialize_tables():
     """
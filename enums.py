@@ -7,11 +7,29 @@ class ForecastModel(str, enum.Enum):
     LINEAR = "linear"
     POLYNOMIAL = "polynomial"
     LOGARITHMIC = "logarithmic"
+    AUTO = "auto"
 
 
 class ForecastGranularity(str, enum.Enum):
-    MUNICIPAL = "municipalities"
+    STATE = "states"
+    GOVERNMENT_DISTRICT = "governmentDistricts"
     DISTRICT = "districts"
+    MUNICIPAL_ASSOCIATION = "municipalAssociations"
+    MUNICIPAL = "municipalities"
+    NUTS_1 = "nuts1"
+    NUTS_2 = "nuts2"
+    NUTS_3 = "nuts3"
+
+
+class ResponseMode(str, enum.Enum):
+    FULL = "full"
+    COEFFICIENTS = "coefficients"
+
+
+class ContentEncoding(str, enum.Enum):
+    IDENTITY = "identity"
+    GZIP = "gzip"
+    ZSTD = "zstd"
 
 
 class ErrorReasons(tuple, enum.Enum):
@@ -1,282 +1,576 @@
 import logging
 import typing
+import zlib
 
 import numpy
 import numpy.polynomial
-import pandas
-import sklearn.metrics
+import pydantic
 
 import enums
 import models
-import tools
+import series
 
 __logger = logging.getLogger(__name__)
 
 
-def run_forecast(**kwargs):
-    _run_forecast(**kwargs)
+def run_forecast(
+    usage_series: series.UsageSeries, model: enums.ForecastModel, forecast_size: int
+) -> series.UsageSeries:
+    return _run_forecast(usage_series, model, forecast_size)
+
+
+_CURVE_DEGREES = {
+    enums.ForecastModel.LINEAR: 1,
+    enums.ForecastModel.POLYNOMIAL: 2,
+    enums.ForecastModel.LOGARITHMIC: 1,
+}
+"""The degree of the polynomial fitted by each model"""
+
+
+def _x_axes(
+    usage_series: series.UsageSeries, forecast_size: int
+) -> tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Get the years of the reference values and the years of all calculated values of the series
+
+    :param usage_series: The series for which the axes are created
+    :param forecast_size: The number of forecasted years
+    :return: The years of the reference values and the years of the reference and forecast values
+    """
+    start_year = usage_series.start_year
+    end_year = usage_series.end_year
+    length = len(usage_series.reference)
+    data_x_axis = numpy.linspace(start=start_year, stop=end_year, num=length, dtype=int)
+    forecast_x_axis = numpy.linspace(
+        start=start_year, stop=end_year + forecast_size, num=length + forecast_size, dtype=int
+    )
+    return data_x_axis, forecast_x_axis
+
+
+def _r2_score(usages: numpy.ndarray, calculated_values: numpy.ndarray, total_sum_of_squares):
+    """
+    Calculate the R² score of the calculated values against the actual usages
+
+    The total sum of squares only depends on the usages and is therefore shared between the
+    models fitted to the same usages. Constant usages are scored with 1 if the calculated values
+    match them exactly and with 0 otherwise
+    """
+    residual_sum_of_squares = numpy.sum((usages - calculated_values) ** 2)
+    if total_sum_of_squares == 0:
+        return 1.0 if residual_sum_of_squares == 0 else 0.0
+    return float(1 - residual_sum_of_squares / total_sum_of_squares)
+
+
+def _adjusted_r2_score(score: float, size: int, degree: int) -> float:
+    """
+    Adjust the R² score for the number of coefficients of the curve
+
+    A curve of a higher degree contains the curves of the lower degrees and never gets a lower R²
+    score on the same usages, so the scores of models with different degrees are only comparable
+    after being adjusted. The adjustment requires more usages than the curve has coefficients
+
+    :param score: The R² score of the curve
+    :param size: The number of usages the curve has been fitted to
+    :param degree: The degree of the curve
+    :return: The adjusted R² score
+    """
+    return 1 - (1 - score) * (size - 1) / (size - degree - 1)
 
 
 def _run_forecast(
-    result_list: list,
-    consumer_group: int,
+    usage_series: series.UsageSeries,
     model: enums.ForecastModel,
-    usages: list,
-    start_year: int,
-    end_year: int,
     forecast_size: int,
-    municipal: int,
-):
-    data_x_axis = numpy.linspace(start=start_year, stop=end_year, num=len(usages), dtype=int)
-    forecast_x_axis = numpy.linspace(
-        start=start_year, stop=end_year + forecast_size, num=len(usages) + forecast_size, dtype=int
-    )
-    data_y_axis = numpy.array(usages, dtype=int)
-    if model is enums.ForecastModel.LINEAR:
-        curve = numpy.polynomial.Polynomial.fit(data_x_axis, data_y_axis, deg=1)
-        all_calculated_values = curve(forecast_x_axis).tolist()
-        calculated_reference_values = all_calculated_values[:len(data_x_axis)]
-        calculated_forecast_values = all_calculated_values[len(data_x_axis):]
-        forecast_score = sklearn.metrics.r2_score(usages, calculated_reference_values)
-        equation = str(curve)
-        forecast_result = {
-            "municipalID": municipal,
-            "consumerGroupID": consumer_group,
-            "forecastedUsages": calculated_forecast_values,
-            "referenceUsages": usages,
-            "forecastEquation": equation,
-            "forecastScore": forecast_score,
-            "forecastType": model.value,
-            "forecastValuesStart": end_year + 1,
-            "referenceValuesStart": start_year,
-        }
-        result_list.append(forecast_result)
-    elif model is enums.ForecastModel.POLYNOMIAL:
-        curve = numpy.polynomial.Polynomial.fit(data_x_axis, data_y_axis, deg=2)
-        all_calculated_values = curve(forecast_x_axis).tolist()
-        calculated_reference_values = all_calculated_values[:len(data_x_axis)]
-        calculated_forecast_values = all_calculated_values[len(data_x_axis):]
-        forecast_score = sklearn.metrics.r2_score(usages, calculated_reference_values)
-        equation = str(curve)
-        forecast_result = {
-            "municipalID": municipal,
-            "consumerGroupID": consumer_group,
-            "forecastedUsages": calculated_forecast_values,
-            "referenceUsages": usages,
-            "forecastEquation": equation,
-            "forecastScore": forecast_score,
-            "forecastType": model.value,
-            "forecastValuesStart": end_year + 1,
-            "referenceValuesStart": start_year,
-        }
-        result_list.append(forecast_result)
-
-    elif model is enums.ForecastModel.LOGARITHMIC:
-        curve = numpy.polynomial.Polynomial.fit(numpy.log(data_x_axis), data_y_axis, deg=1)
-        all_calculated_values = curve(forecast_x_axis).tolist()
-        calculated_reference_values = all_calculated_values[:len(data_x_axis)]
-        calculated_forecast_values = all_calculated_values[len(data_x_axis):]
-        forecast_score = sklearn.metrics.r2_score(usages, calculated_reference_values)
-        equation = str(curve)
-        forecast_result = {
-            "municipalID": municipal,
-            "consumerGroupID": consumer_group,
-            "forecastedUsages": calculated_forecast_values,
-            "referenceUsages": usages,
-            "forecastEquation": equation,
-            "forecastScore": forecast_score,
-            "forecastType": model.value,
-            "forecastValuesStart": end_year + 1,
-            "referenceValuesStart": start_year,
-        }
-        result_list.append(forecast_result)
+) -> series.UsageSeries:
+    usages = usage_series.reference
+    if model is enums.ForecastModel.AUTO:
+        # curves passing through every usage cannot be ranked, so short series fall back to linear
+        fitted_models = tuple(
+            fitted_model
+            for fitted_model, degree in _CURVE_DEGREES.items()
+            if len(usages) > degree + 1
+        )
+        ranked = len(fitted_models) > 0
+        fitted_models = fitted_models or (enums.ForecastModel.LINEAR,)
+    elif model in _CURVE_DEGREES:
+        fitted_models = (model,)
+        ranked = False
     else:
         raise ValueError("The supplied forecast model is not allowed")
+    # %% Prepare the axes shared by all fitted models
+    data_x_axis, forecast_x_axis = _x_axes(usage_series, forecast_size)
+    data_y_axis = usages.astype(int)
+    total_sum_of_squares = numpy.sum((usages - usages.mean()) ** 2)
+    # %% Fit every model and keep the one with the best adjusted score
+    scores = {}
+    best_ranking_score = -numpy.inf
+    for fitted_model in fitted_models:
+        if fitted_model is enums.ForecastModel.LOGARITHMIC:
+            fit_x_axis, evaluation_x_axis = numpy.log(data_x_axis), numpy.log(forecast_x_axis)
+        else:
+            fit_x_axis, evaluation_x_axis = data_x_axis, forecast_x_axis
+        curve = numpy.polynomial.Polynomial.fit(
+            fit_x_axis, data_y_axis, deg=_CURVE_DEGREES[fitted_model]
+        )
+        all_calculated_values = curve(evaluation_x_axis)
+        calculated_reference_values = all_calculated_values[: len(data_x_axis)]
+        score = _r2_score(usages, calculated_reference_values, total_sum_of_squares)
+        ranking_score = score
+        if ranked:
+            ranking_score = _adjusted_r2_score(score, len(usages), _CURVE_DEGREES[fitted_model])
+            scores[fitted_model] = ranking_score
+        if ranking_score <= best_ranking_score:
+            continue
+        best_ranking_score = ranking_score
+        usage_series.model = fitted_model
+        usage_series.curve = curve
+        usage_series.forecast = all_calculated_values[len(data_x_axis) :]
+        usage_series.score = score
+    if model is enums.ForecastModel.AUTO:
+        usage_series.scores = scores
+    return usage_series
 
 
-def build_response(responses, request, municipals, consumer_groups, forecast_result):
-    forecast_data = models.Forecast(
-        model=forecast_result.get("forecastType"),
-        equation=forecast_result.get("forecastEquation"),
-        score=forecast_result.get("forecastScore"),
-        usages=models.Usages(
-            start=forecast_result.get("forecastValuesStart"),
-            end=forecast_result.get("forecastValuesStart") + request.forecast_size - 1,
-            amounts=forecast_result.get("forecastedUsages"),
-        ),
+_MIN_RESAMPLES = 100
+"""The number of resamples below which the resamples requested by a query are not reduced"""
+
+
+def calculate_prediction_intervals(
+    calculated_series: list[series.UsageSeries],
+    quantiles: list[float],
+    resamples: int,
+    series_count: int,
+    budget: int,
+) -> None:
+    """
+    Calculate prediction intervals for the forecasts of the series by bootstrapping the residuals
+
+    The series are batched by their model and length. For every batch the residuals of all series
+    are resampled at once into a (series × resamples × years) array and the curves are refitted
+    with a batched least squares solution. The requested quantiles of the refitted forecasts are
+    stored as bands on the series
+
+    The budget is shared by all series requested by the query. A series gets the requested number
+    of resamples unless its share of the budget is exhausted earlier, but never fewer than
+    ``_MIN_RESAMPLES``. The number of resamples only depends on the number of requested series and
+    the lengths of the series, and the residuals of every series are resampled from a generator
+    seeded by its municipal and consumer group. So the bands of a series do not depend on the load
+    or on the other series calculated with it. Batches exceeding the budget are split up
+
+    :param calculated_series: The series whose forecasts have already been calculated
+    :param quantiles: The quantiles which shall be returned as bands
+    :param resamples: The requested number of resamples per series
+    :param series_count: The number of series requested by the query, which may be calculated
+        in multiple calls
+    :param budget: The max. number of bootstrapped values calculated for the series of the query
+    """
+    batches = {}
+    for s in calculated_series:
+        batches.setdefault((s.model, len(s.reference), len(s.forecast)), []).append(s)
+    for (model, length, forecast_size), batch in batches.items():
+        allowed_resamples = budget // (max(1, series_count) * (length + forecast_size))
+        batch_resamples = min(resamples, max(_MIN_RESAMPLES, allowed_resamples))
+        if batch_resamples < resamples:
+            __logger.info(
+                "Reducing the bootstrap resamples of %s series from %s to %s to stay within the "
+                "budget",
+                len(batch),
+                resamples,
+                batch_resamples,
+            )
+        batch_size = max(1, budget // (batch_resamples * (length + forecast_size)))
+        for offset in range(0, len(batch), batch_size):
+            _bootstrap_batch(
+                batch[offset : offset + batch_size],
+                model,
+                length,
+                forecast_size,
+                quantiles,
+                batch_resamples,
+            )
+
+
+def _series_rng(usage_series: series.UsageSeries) -> numpy.random.Generator:
+    """
+    Get the random number generator used to resample the residuals of the series
+
+    The generator is seeded by the municipal and the consumer group of the series, so identical
+    requests get identical bands however their series are split into shards, chunks and batches
+    """
+    return numpy.random.default_rng(
+        [
+            zlib.crc32(usage_series.municipal.encode("utf-8")),
+            zlib.crc32(str(usage_series.consumer_group).encode("utf-8")),
+        ]
     )
-    municipal = models.Municipal(
-        key=municipals[forecast_result.get("municipalID")][1],
-        name=municipals[forecast_result.get("municipalID")][0],
-        nuts_key=municipals[forecast_result.get("municipalID")][2],
+
+
+def _bootstrap_batch(
+    batch: list[series.UsageSeries],
+    model: enums.ForecastModel,
+    length: int,
+    forecast_size: int,
+    quantiles: list[float],
+    resamples: int,
+) -> None:
+    """Bootstrap the prediction intervals of series sharing the model and their lengths"""
+    degree = _CURVE_DEGREES[model]
+    fit_axes = numpy.empty((len(batch), length + forecast_size), dtype=numpy.float64)
+    for index, s in enumerate(batch):
+        _, forecast_x_axis = _x_axes(s, forecast_size)
+        if model is enums.ForecastModel.LOGARITHMIC:
+            forecast_x_axis = numpy.log(forecast_x_axis)
+        # map the axis onto the window of the fitted curve, as the point forecast does
+        offset, scale = s.curve.mapparms()
+        fit_axes[index] = offset + scale * forecast_x_axis
+    # %% Solve the least squares problems of all series at once
+    design = fit_axes[:, :, numpy.newaxis] ** numpy.arange(degree + 1)
+    reference_design, forecast_design = design[:, :length], design[:, length:]
+    solver = numpy.linalg.pinv(reference_design)
+    usages = numpy.stack([s.reference.astype(int) for s in batch]).astype(numpy.float64)
+    fitted_usages = numpy.einsum(
+        "snp,sp->sn", reference_design, numpy.einsum("spn,sn->sp", solver, usages)
     )
-    consumer_group = models.ConsumerGroup(
-        key=consumer_groups[forecast_result.get("consumerGroupID")][0],
-        name=consumer_groups[forecast_result.get("consumerGroupID")][1],
+    residuals = usages - fitted_usages
+    # %% Resample the residuals and refit the curves
+    resample_indices = numpy.stack(
+        [
+            _series_rng(s).integers(0, length, size=(resamples, length + forecast_size))
+            for s in batch
+        ]
     )
-    responses.append(
-        models.ForecastResult(
-            forecast=forecast_data,
-            reference_usages=models.Usages(
-                start=forecast_result.get("referenceValuesStart"),
-                end=forecast_result.get("referenceValuesStart")
-                + len(forecast_result.get("referenceUsages"))
-                - 1,
-                amounts=forecast_result.get("referenceUsages"),
+    resampled_residuals = numpy.take_along_axis(
+        residuals[:, numpy.newaxis, :], resample_indices[:, :, :length], axis=2
+    )
+    coefficients = numpy.einsum(
+        "spn,sbn->sbp", solver, fitted_usages[:, numpy.newaxis, :] + resampled_residuals
+    )
+    forecasts = numpy.einsum("sfp,sbp->sbf", forecast_design, coefficients)
+    # add resampled residuals to cover the variation of the future values around the curve
+    forecasts += numpy.take_along_axis(
+        residuals[:, numpy.newaxis, :], resample_indices[:, :, length:], axis=2
+    )
+    bands = numpy.quantile(forecasts, quantiles, axis=1)
+    for index, s in enumerate(batch):
+        s.bands = {quantile: bands[q, index] for q, quantile in enumerate(quantiles)}
+        s.resamples = resamples
+
+
+def _by_alias(response_model: typing.Type[pydantic.BaseModel], /, **values) -> dict:
+    """
+    Key the values of the fields of a model by the aliases the model is serialized with
+
+    The partial responses are not validated by instantiating the models, since that is too slow
+    for large responses. A field missing from the model raises a ``KeyError``
+
+    :param response_model: The model describing the serialized values
+    :param values: The values keyed by the names of the fields
+    :return: The values keyed by the aliases of the fields
+    """
+    return {response_model.__fields__[name].alias: value for name, value in values.items()}
+
+
+def build_response(
+    request, municipals: dict, consumer_groups: dict, usage_series: series.UsageSeries
+) -> dict:
+    """
+    Convert a calculated usage series into the partial response sent to the client
+
+    The returned dictionary has the layout of ``models.ForecastResult`` serialized by its
+    aliases. The value arrays are only converted into lists at this point. In the coefficients
+    response mode only the fitted curve is returned instead of the forecasted values.
+    """
+    municipal = municipals[usage_series.municipal]
+    consumer_group = consumer_groups[usage_series.consumer_group]
+    forecast_end = usage_series.forecast_start + request.forecast_size - 1
+    if request.response_mode is enums.ResponseMode.COEFFICIENTS:
+        forecasted_usages = None
+        curve = _by_alias(
+            models.Curve,
+            coefficients=usage_series.curve.coef.tolist(),
+            domain=usage_series.curve.domain.tolist(),
+            window=usage_series.curve.window.tolist(),
+            start=usage_series.forecast_start,
+            end=forecast_end,
+        )
+    else:
+        forecasted_usages = _by_alias(
+            models.Usages,
+            start=usage_series.forecast_start,
+            end=forecast_end,
+            amounts=usage_series.forecast.tolist(),
+            bands=(
+                {str(quantile): band.tolist() for quantile, band in usage_series.bands.items()}
+                if usage_series.bands is not None
+                else None
+            ),
+            resamples=usage_series.resamples,
+        )
+        curve = None
+    return _by_alias(
+        models.ForecastResult,
+        forecast=_by_alias(
+            models.Forecast,
+            model=usage_series.model.value,
+            equation=str(usage_series.curve),
+            score=usage_series.score,
+            scores=(
+                {model.value: score for model, score in usage_series.scores.items()}
+                if usage_series.scores is not None
+                else None
             ),
-            municipal=municipal,
-            consumer_group=consumer_group,
-        ).dict(by_alias=True)
+            usages=forecasted_usages,
+            curve=curve,
+        ),
+        reference_usages=(
+            _by_alias(
+                models.Usages,
+                start=usage_series.start_year,
+                end=usage_series.reference_end,
+                amounts=usage_series.reference.tolist(),
+            )
+            if request.include_reference
+            else None
+        ),
+        municipal=_by_alias(
+            models.Municipal, key=municipal[1], name=municipal[0], nuts_key=municipal[2]
+        ),
+        consumer_group=_by_alias(
+            models.ConsumerGroup, key=consumer_group[0], name=consumer_group[1]
+        ),
     )
 
 
-def accumulate_by_municipals(forecast_results: list[dict], municipals: dict) -> typing.Dict:
-    __logger.info("Starting accumulation by municipals")
-    # %% Convert the dictionaries into pydantic objects
-    forecast_results = [models.ForecastResult.parse_obj(o) for o in forecast_results]
-    # %% Create an empty dataframe which will contain the data
-    df_reference_usages = pandas.DataFrame(columns=["municipal", "year", "usage"])
-    df_forecasted_usages = pandas.DataFrame(columns=["municipal", "year", "usage"])
-    # %% Create and append data to the reference usage data frame
-    for r in forecast_results:
-        # Create the row values for the reference data
-        ref_municipal = [r.municipal.key for v in r.reference_usages.amounts]
-        ref_years = [str(y) for y in range(r.reference_usages.start, r.reference_usages.end + 1)]
-        ref_rows = zip(ref_municipal, ref_years, r.reference_usages.amounts)
-        # Concatenate the reference data values
-        _df = pandas.DataFrame(ref_rows, columns=["municipal", "year", "usage"])
-        df_reference_usages = pandas.concat([df_reference_usages, _df], ignore_index=True)
-        # Create the row values for the forecast data
-        forecast_municipal = [r.municipal.key for _ in r.forecast.usages.amounts]
-        forecast_years = [str(y) for y in range(r.forecast.usages.start, r.forecast.usages.end + 1)]
-        forecast_rows = zip(forecast_municipal, forecast_years, r.forecast.usages.amounts)
-        # Concatenate the forecasted data values
-        _df = pandas.DataFrame(forecast_rows, columns=["municipal", "year", "usage"])
-        df_forecasted_usages = pandas.concat([df_forecasted_usages, _df], ignore_index=True)
-    # %% Group the data and sum up the reference data
-    reference_aggregation = df_reference_usages.groupby(["municipal", "year"]).aggregate(numpy.sum)
-    forecast_aggregation = df_forecasted_usages.groupby(["municipal", "year"]).aggregate(numpy.sum)
-    raw_reference_aggregation = reference_aggregation.to_dict(orient="dict")["usage"]
-    raw_forecast_aggregation: dict = forecast_aggregation.to_dict(orient="dict")["usage"]
-    # %% Transform the reference aggregation data
-    reference_aggregation_dict = {}
-    years = {}
-    usages = {}
-    for key, usage in raw_reference_aggregation.items():
-        municipal, year = key
-        if years.get(municipal, None) is None:
-            years.update({municipal: []})
-        if usages.get(municipal, None) is None:
-            usages.update({municipal: []})
-        years.get(municipal, None).append(year)
-        usages.get(municipal, None).append(usage)
-    for municipal in years:
-        return_values = {
-            "startYear": int(years.get(municipal)[0]),
-            "endYear": int(years.get(municipal)[-1]),
-            "usages": usages.get(municipal),
-            "displayName": municipals.get(municipal)[0],
-            "nutsKey": municipals.get(municipal)[1],
-        }
-        reference_aggregation_dict.update({municipal: return_values})
-    # %% Transform the forecast aggregation data
-    forecast_aggregation_dict = {}
-    years = {}
-    usages = {}
-    for key, usage in raw_forecast_aggregation.items():
-        municipal, year = key
-        if years.get(municipal, None) is None:
-            years.update({municipal: []})
-        if usages.get(municipal, None) is None:
-            usages.update({municipal: []})
-        years.get(municipal, None).append(year)
-        usages.get(municipal, None).append(usage)
-    for municipal in years:
-        return_values = {
-            "startYear": int(years.get(municipal)[0]),
-            "endYear": int(years.get(municipal)[-1]),
-            "usages": usages.get(municipal),
-            "displayName": municipals.get(municipal)[0],
-            "nutsKey": municipals.get(municipal)[1],
-        }
-        forecast_aggregation_dict.update({municipal: return_values})
-    __logger.info("Finished aggregation by municipals")
-    return {"reference": reference_aggregation_dict, "forecast": forecast_aggregation_dict}
-
-
-def accumulate_by_consumer_groups(
-    forecast_results: list[dict], consumer_groups: dict
-) -> typing.Dict:
-    # %% Convert the dictionaries into pydantic objects
-    __logger.info("Starting aggregation by consumer groups")
-    forecast_results = [models.ForecastResult.parse_obj(o) for o in forecast_results]
-    # %% Create an empty dataframe which will contain the data
-    df_reference_usages = pandas.DataFrame(columns=["consumerGroup", "year", "usage"])
-    df_forecasted_usages = pandas.DataFrame(columns=["consumerGroup", "year", "usage"])
-    # %% Create and append data to the reference usage data frame
-    for r in forecast_results:
-        # Create the row values for the reference data
-        ref_cg = [r.consumer_group.key for v in r.reference_usages.amounts]
-        ref_years = [str(y) for y in range(r.reference_usages.start, r.reference_usages.end + 1)]
-        ref_rows = zip(ref_cg, ref_years, r.reference_usages.amounts)
-        # Concatenate the reference data values
-        _df = pandas.DataFrame(ref_rows, columns=["consumerGroup", "year", "usage"])
-        df_reference_usages = pandas.concat([df_reference_usages, _df], ignore_index=True)
-        # Create the row values for the forecast data
-        forecast_cg = [r.consumer_group.key for _ in r.forecast.usages.amounts]
-        forecast_years = [str(y) for y in range(r.forecast.usages.start, r.forecast.usages.end + 1)]
-        forecast_rows = zip(forecast_cg, forecast_years, r.forecast.usages.amounts)
-        # Concatenate the forecasted data values
-        _df = pandas.DataFrame(forecast_rows, columns=["consumerGroup", "year", "usage"])
-        df_forecasted_usages = pandas.concat([df_forecasted_usages, _df], ignore_index=True)
-    # %% Group the data and sum up the reference data
-    reference_aggregation = df_reference_usages.groupby(["consumerGroup", "year"]).aggregate(
-        numpy.sum
+class UsageMatrix:
+    """
+    The values of multiple series aligned onto a common range of years
+
+    Every row of the matrix contains the values of one series. Years in which a series has no
+    values are filled with zeros and are marked as not covered
+    """
+
+    __slots__ = ("first_year", "values", "coverage")
+
+    def __init__(self, starts: typing.Sequence[int], arrays: typing.Sequence[numpy.ndarray]):
+        self.first_year = min(starts, default=0)
+        """The year of the first column of the matrix"""
+
+        last_year = max((start + len(values) for start, values in zip(starts, arrays)), default=0)
+        self.values = numpy.zeros((len(arrays), last_year - self.first_year), dtype=numpy.float64)
+        """The values of the series"""
+
+        self.coverage = numpy.zeros(self.values.shape, dtype=bool)
+        """Whether a series contains a value for the year"""
+
+        for row, (start, values) in enumerate(zip(starts, arrays)):
+            columns = slice(start - self.first_year, start - self.first_year + len(values))
+            self.values[row, columns] = values
+            self.coverage[row, columns] = True
+
+    def sum_by(self, keys: typing.Sequence) -> dict[typing.Any, tuple[int, numpy.ndarray]]:
+        """
+        Sum up the rows which share the same key
+
+        The rows are sorted by their keys and every segment of equal keys is reduced in a single
+        ``numpy.add.reduceat`` call. The sums are trimmed to the years covered by the segment.
+        Rows whose key is ``None`` are not part of any sum
+
+        :param keys: The key of every row
+        :return: A mapping of the keys to the first covered year and the summed up values
+        """
+        rows = numpy.array([row for row, key in enumerate(keys) if key is not None], dtype=int)
+        if len(rows) == 0:
+            return {}
+        keys = numpy.asarray([keys[row] for row in rows])
+        key_order = numpy.argsort(keys, kind="stable")
+        order = rows[key_order]
+        sorted_keys = keys[key_order]
+        segment_starts = numpy.flatnonzero(
+            numpy.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1]))
+        )
+        sums = numpy.add.reduceat(self.values[order], segment_starts, axis=0)
+        coverage = numpy.logical_or.reduceat(self.coverage[order], segment_starts, axis=0)
+        results = {}
+        for key, segment_sums, segment_coverage in zip(sorted_keys[segment_starts], sums, coverage):
+            covered_columns = numpy.flatnonzero(segment_coverage)
+            first, last = covered_columns[0], covered_columns[-1]
+            results[key.item()] = (
+                self.first_year + int(first),
+                segment_sums[first : last + 1],
+            )
+        return results
+
+
+def _usage_matrices(forecast_results: list[series.UsageSeries]) -> tuple[UsageMatrix, UsageMatrix]:
+    """Align the reference values and the forecasted values of the series into matrices"""
+    reference_matrix = UsageMatrix(
+        [r.start_year for r in forecast_results], [r.reference for r in forecast_results]
     )
-    forecast_aggregation = df_forecasted_usages.groupby(["consumerGroup", "year"]).aggregate(
-        numpy.sum
+    forecast_matrix = UsageMatrix(
+        [r.forecast_start for r in forecast_results], [r.forecast for r in forecast_results]
     )
-    raw_reference_aggregation = reference_aggregation.to_dict(orient="dict")["usage"]
-    raw_forecast_aggregation: dict = forecast_aggregation.to_dict(orient="dict")["usage"]
-    # %% Transform the reference aggregation data
-    reference_aggregation_dict = {}
-    years = {}
-    usages = {}
-    for key, usage in raw_reference_aggregation.items():
-        cg, year = key
-        if years.get(cg, None) is None:
-            years.update({cg: []})
-        if usages.get(cg, None) is None:
-            usages.update({cg: []})
-        years.get(cg, None).append(year)
-        usages.get(cg, None).append(usage)
-    for cg in years:
-        return_values = {
-            "startYear": int(years.get(cg)[0]),
-            "endYear": int(years.get(cg)[-1]),
-            "usages": usages.get(cg),
-            "displayName": consumer_groups.get(cg),
+    return reference_matrix, forecast_matrix
+
+
+def _merge_sums(running_sums: dict, sums: dict) -> None:
+    """
+    Add the sums of a chunk onto the running sums, aligning the values by their years
+
+    :param running_sums: The running sums which are updated in place
+    :param sums: The sums of the chunk
+    """
+    for key, (start, values) in sums.items():
+        if key not in running_sums:
+            running_sums[key] = (start, values)
+            continue
+        running_start, running_values = running_sums[key]
+        merged_start = min(start, running_start)
+        merged_end = max(start + len(values), running_start + len(running_values))
+        merged_values = numpy.zeros(merged_end - merged_start, dtype=numpy.float64)
+        for part_start, part_values in ((start, values), (running_start, running_values)):
+            offset = part_start - merged_start
+            merged_values[offset : offset + len(part_values)] += part_values
+        running_sums[key] = (merged_start, merged_values)
+
+
+def _format_sums(sums: dict, **attributes: typing.Callable[[typing.Any], typing.Any]) -> dict:
+    """
+    Convert the summed up values into the accumulation entries sent to the client
+
+    :param sums: A mapping of the keys to the first year and the summed up values
+    :param attributes: Functions returning the additional attributes of an entry from its key
+    :return: The accumulation entries ordered by their keys
+    """
+    return {
+        key: {
+            "startYear": start,
+            "endYear": start + len(usages) - 1,
+            "usages": usages.tolist(),
+            **{name: attribute(key) for name, attribute in attributes.items()},
+        }
+        for key, (start, usages) in sorted(sums.items())
+    }
+
+
+_KEY_PREFIX_LENGTHS = {
+    enums.ForecastGranularity.STATE: 2,
+    enums.ForecastGranularity.GOVERNMENT_DISTRICT: 3,
+    enums.ForecastGranularity.DISTRICT: 5,
+    enums.ForecastGranularity.MUNICIPAL_ASSOCIATION: 9,
+    enums.ForecastGranularity.MUNICIPAL: 12,
+}
+"""The length of the municipal key prefix identifying the areas of a level"""
+
+_NUTS_KEY_PREFIX_LENGTHS = {
+    enums.ForecastGranularity.NUTS_1: 3,
+    enums.ForecastGranularity.NUTS_2: 4,
+    enums.ForecastGranularity.NUTS_3: 5,
+}
+"""The length of the NUTS key prefix identifying the areas of a level"""
+
+
+def rollup_keys(
+    municipal_keys: typing.Iterable[str],
+    municipals: dict,
+    level: enums.ForecastGranularity,
+) -> list[str]:
+    """
+    Get the key of the area on the level in which each of the municipals lies
+
+    Municipals without a NUTS key do not lie in any area of the NUTS levels and get ``None`` as
+    their key on these levels
+
+    :param municipal_keys: The official municipal keys of the municipals
+    :param municipals: The mapping of the municipal keys to their names, keys and NUTS keys
+    :param level: The level of the areas
+    :return: The keys of the areas
+    """
+    if level in _NUTS_KEY_PREFIX_LENGTHS:
+        length = _NUTS_KEY_PREFIX_LENGTHS[level]
+        nuts_keys = [municipals.get(municipal_key)[2] for municipal_key in municipal_keys]
+        return [nuts_key[:length] if nuts_key else None for nuts_key in nuts_keys]
+    length = _KEY_PREFIX_LENGTHS[level]
+    return [municipal_key[:length] for municipal_key in municipal_keys]
+
+
+class Accumulation:
+    """
+    The accumulated usages of the series of a query by municipals, consumer groups and levels
+
+    The series may be added in multiple chunks. The values of a chunk are aligned into one matrix
+    which is summed up for every grouping, and the sums are merged into the running sums
+    """
+
+    def __init__(
+        self, municipals: dict, consumer_groups: dict, levels: list[enums.ForecastGranularity]
+    ):
+        self._municipals = municipals
+        self._consumer_groups = consumer_groups
+        self._levels = levels
+        self._reference_sums = {grouping: {} for grouping in ("municipal", "consumerGroup")}
+        self._forecast_sums = {grouping: {} for grouping in ("municipal", "consumerGroup")}
+        for level in levels:
+            self._reference_sums[level] = {}
+            self._forecast_sums[level] = {}
+
+    def add(self, forecast_results: list[series.UsageSeries]) -> None:
+        """
+        Add the calculated series of a chunk onto the accumulations
+
+        :param forecast_results: The calculated series
+        """
+        if len(forecast_results) == 0:
+            return
+        reference_matrix, forecast_matrix = _usage_matrices(forecast_results)
+        municipal_keys = [r.municipal for r in forecast_results]
+        keys = {
+            "municipal": municipal_keys,
+            "consumerGroup": [
+                self._consumer_groups.get(r.consumer_group)[0] for r in forecast_results
+            ],
+        }
+        for level in self._levels:
+            keys[level] = rollup_keys(municipal_keys, self._municipals, level)
+        for grouping, grouping_keys in keys.items():
+            _merge_sums(self._reference_sums[grouping], reference_matrix.sum_by(grouping_keys))
+            _merge_sums(self._forecast_sums[grouping], forecast_matrix.sum_by(grouping_keys))
+
+    def result(self, area_names: dict) -> typing.Dict:
+        """
+        Get the accumulations in the form sent to the client
+
+        :param area_names: The mapping of the area keys to the display names of the areas
+        :return: The accumulations by municipals, consumer groups and levels
+        """
+        municipal_attributes = {
+            "displayName": lambda municipal: self._municipals.get(municipal)[0],
+            "nutsKey": lambda municipal: self._municipals.get(municipal)[2],
         }
-        reference_aggregation_dict.update({cg: return_values})
-    # %% Transform the forecast aggregation data
-    forecast_aggregation_dict = {}
-    years = {}
-    usages = {}
-    for key, usage in raw_forecast_aggregation.items():
-        cg, year = key
-        if years.get(cg, None) is None:
-            years.update({cg: []})
-        if usages.get(cg, None) is None:
-            usages.update({cg: []})
-        years.get(cg, None).append(year)
-        usages.get(cg, None).append(usage)
-    for cg in years:
-        return_values = {
-            "startYear": int(years.get(cg)[0]),
-            "endYear": int(years.get(cg)[-1]),
-            "usages": usages.get(cg),
-            "displayName": consumer_groups.get(cg),
+        consumer_group_names = {key: name for key, name in self._consumer_groups.values()}
+        return {
+            "municipal": {
+                "reference": _format_sums(
+                    self._reference_sums["municipal"], **municipal_attributes
+                ),
+                "forecast": _format_sums(self._forecast_sums["municipal"], **municipal_attributes),
+            },
+            "consumerGroup": {
+                "reference": _format_sums(
+                    self._reference_sums["consumerGroup"], displayName=consumer_group_names.get
+                ),
+                "forecast": _format_sums(
+                    self._forecast_sums["consumerGroup"], displayName=consumer_group_names.get
+                ),
+            },
+            "levels": {
+                level.value: {
+                    "reference": _format_sums(
+                        self._reference_sums[level], displayName=area_names.get
+                    ),
+                    "forecast": _format_sums(
+                        self._forecast_sums[level], displayName=area_names.get
+                    ),
+                }
+                for level in self._levels
+            },
         }
-        forecast_aggregation_dict.update({cg: return_values})
-    __logger.info("Finished aggregation by consumer groups")
-    return {"reference": reference_aggregation_dict, "forecast": forecast_aggregation_dict}
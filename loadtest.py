@@ -0,0 +1,284 @@
+"""Load test of the forecast executor using an in-process stand-in for the message broker"""
+import argparse
+import dataclasses
+import logging
+import queue
+import random
+import resource
+import sys
+import threading
+import time
+import typing
+
+import numpy
+import sqlalchemy
+import ujson
+from sqlalchemy.sql import select
+
+import database
+import database.tables
+import enums
+import server_functions
+
+_logger = logging.getLogger("loadtest")
+
+_KEY_LENGTHS = {"municipal": 12, "district": 5, "state": 2}
+"""The length of the keys which are requested for the request sizes"""
+
+_PERCENTILES = (50, 95, 99)
+
+
+@dataclasses.dataclass
+class _Delivery:
+    """A message published onto the in-process broker and the timings of its handling"""
+
+    body: bytes
+    label: str
+    published: float
+    started: float = 0.0
+    finished: float = 0.0
+    status: str = "pending"
+    reply_size: int = 0
+    result: typing.Any = None
+
+
+class InProcessBroker:
+    """
+    A stand-in for the message broker and the consumers of the ``amqp_rpc_server`` package
+
+    Every consumer handles a single message at a time like a consumer with a prefetch count of
+    one, so the number of consumers corresponds to the number of service replicas. A message is
+    passed through the content validator first and is only passed to the executor if it is valid.
+    The optional reply handler is called with every reply and its result is kept with the message.
+    Errors raised while handling a message are logged and mark the message as failed, so the
+    consumers keep running
+    """
+
+    def __init__(
+        self,
+        content_validator: typing.Callable[[bytes], bool],
+        executor: typing.Callable[[bytes], bytes],
+        consumers: int,
+        reply_handler: typing.Optional[typing.Callable[[bytes], typing.Any]] = None,
+    ):
+        self._content_validator = content_validator
+        self._executor = executor
+        self._reply_handler = reply_handler
+        self._queue: "queue.Queue[typing.Optional[_Delivery]]" = queue.Queue()
+        self._consumers = [
+            threading.Thread(target=self._consume, name=f"consumer-{index}", daemon=True)
+            for index in range(consumers)
+        ]
+        self.deliveries: list[_Delivery] = []
+
+    def start(self) -> None:
+        for consumer in self._consumers:
+            consumer.start()
+
+    def publish(self, body: bytes, label: str) -> None:
+        """
+        Publish a message onto the queue of the broker
+
+        :param body: The body of the message
+        :param label: The label under which the handling of the message is reported
+        """
+        delivery = _Delivery(body=body, label=label, published=time.perf_counter())
+        self.deliveries.append(delivery)
+        self._queue.put(delivery)
+
+    def join(self) -> None:
+        """Wait until all published messages have been handled and stop the consumers"""
+        for _ in self._consumers:
+            self._queue.put(None)
+        for consumer in self._consumers:
+            consumer.join()
+
+    def _consume(self) -> None:
+        while (delivery := self._queue.get()) is not None:
+            delivery.started = time.perf_counter()
+            reply = None
+            try:
+                if not self._content_validator(delivery.body):
+                    delivery.status = "rejected"
+                else:
+                    reply = self._executor(delivery.body)
+                    delivery.reply_size = len(reply)
+                    delivery.status = "ok"
+            except Exception as execution_error:
+                _logger.error("Unable to handle a message", exc_info=execution_error)
+                delivery.status = "error"
+            delivery.finished = time.perf_counter()
+            if reply is None or self._reply_handler is None:
+                continue
+            try:
+                delivery.result = self._reply_handler(reply)
+            except Exception as handler_error:
+                _logger.error("Unable to handle a reply", exc_info=handler_error)
+                delivery.status = "error"
+
+
+def _parse_weights(value: str) -> dict[str, float]:
+    """Parse a comma separated list of ``name=weight`` pairs"""
+    weights = {}
+    for pair in value.split(","):
+        name, _, weight = pair.partition("=")
+        weights[name.strip()] = float(weight) if weight else 1.0
+    return weights
+
+
+def _sample_keys(sizes: typing.Iterable[str], samples: int, rng: random.Random) -> dict:
+    """
+    Sample the keys of the areas which are requested for every request size
+
+    :param sizes: The request sizes which are part of the request mix
+    :param samples: The maximal number of keys sampled per request size
+    :param rng: The random number generator used to sample the keys
+    :return: A mapping of the request sizes to the sampled keys
+    """
+    keys = {}
+    for size in sizes:
+        key_query = select(
+            [database.tables.shapes.c.key],
+            sqlalchemy.func.length(database.tables.shapes.c.key) == _KEY_LENGTHS[size],
+        )
+        available_keys = [row[0] for row in database.engine.execute(key_query).all()]
+        if len(available_keys) == 0:
+            raise ValueError(f"The database contains no keys for the request size {size}")
+        keys[size] = rng.sample(available_keys, min(samples, len(available_keys)))
+    return keys
+
+
+def summarize_durations(values: numpy.ndarray) -> dict:
+    """Get the mean and the percentiles of the durations in milliseconds"""
+    if len(values) == 0:
+        return {}
+    summary = {"mean": float(values.mean() * 1000)}
+    for percentile, value in zip(_PERCENTILES, numpy.percentile(values, _PERCENTILES)):
+        summary[f"p{percentile}"] = float(value * 1000)
+    summary["max"] = float(values.max() * 1000)
+    return summary
+
+
+def build_report(deliveries: list[_Delivery], wall_time: float) -> dict:
+    """
+    Build the report of a load test run
+
+    :param deliveries: The messages handled during the run
+    :param wall_time: The number of seconds between the first publication and the last reply
+    :return: The throughput, latencies, queue waits and service times overall and per label
+    """
+    report = {
+        "messages": len(deliveries),
+        "wallTime": wall_time,
+        "throughput": len(deliveries) / wall_time if wall_time > 0 else 0.0,
+        "peakMemory": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "connectionPool": database.pool_statistics(),
+        "labels": {},
+    }
+    groups = {"total": deliveries}
+    for delivery in deliveries:
+        groups.setdefault(delivery.label, []).append(delivery)
+    for label, group in groups.items():
+        published = numpy.array([d.published for d in group])
+        started = numpy.array([d.started for d in group])
+        finished = numpy.array([d.finished for d in group])
+        statistics = {
+            "messages": len(group),
+            "statuses": {
+                status: sum(d.status == status for d in group)
+                for status in sorted({d.status for d in group})
+            },
+            "latency": summarize_durations(finished - published),
+            "queueWait": summarize_durations(started - published),
+            "serviceTime": summarize_durations(finished - started),
+            "meanReplySize": float(numpy.mean([d.reply_size for d in group])),
+        }
+        if label == "total":
+            report.update(statistics)
+        else:
+            report["labels"][label] = statistics
+    return report
+
+
+def run(
+    rate: float,
+    messages: int,
+    consumers: int,
+    sizes: dict[str, float],
+    models: dict[str, float],
+    forecast_size: int,
+    seed: int,
+) -> dict:
+    """
+    Publish the messages with exponentially distributed gaps and report their handling
+
+    :param rate: The mean number of messages published per second
+    :param messages: The number of messages which are published
+    :param consumers: The number of consumers handling the messages concurrently
+    :param sizes: The weights of the request sizes in the request mix
+    :param models: The weights of the forecast models in the request mix
+    :param forecast_size: The number of years which are forecasted
+    :param seed: The seed of the random number generator
+    :return: The report of the run
+    """
+    rng = random.Random(seed)
+    keys = _sample_keys(sizes, 50, rng)
+    broker = InProcessBroker(
+        server_functions.content_validator, server_functions.executor, consumers
+    )
+    broker.start()
+    _logger.info("Publishing %s messages at a mean rate of %s messages/s", messages, rate)
+    start = time.perf_counter()
+    next_publication = start
+    for _ in range(messages):
+        size = rng.choices(list(sizes), weights=list(sizes.values()))[0]
+        model = rng.choices(list(models), weights=list(models.values()))[0]
+        body = ujson.dumps(
+            {"model": model, "keys": [rng.choice(keys[size])], "forecastSize": forecast_size}
+        ).encode("utf-8")
+        time.sleep(max(next_publication - time.perf_counter(), 0))
+        broker.publish(body, f"{size}/{model}")
+        next_publication += rng.expovariate(rate)
+    broker.join()
+    return build_report(broker.deliveries, time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rate", type=float, default=2.0, help="mean messages per second")
+    parser.add_argument("--messages", type=int, default=100, help="number of messages")
+    parser.add_argument("--consumers", type=int, default=1, help="concurrent consumers")
+    parser.add_argument(
+        "--sizes",
+        type=_parse_weights,
+        default="municipal=6,district=3,state=1",
+        help=f"weighted request sizes out of {', '.join(_KEY_LENGTHS)}",
+    )
+    parser.add_argument(
+        "--models",
+        type=_parse_weights,
+        default=",".join(model.value for model in enums.ForecastModel),
+        help="weighted forecast models",
+    )
+    parser.add_argument("--forecast-size", type=int, default=20, help="forecasted years")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the request mix")
+    parser.add_argument("--output", help="file the JSON report is written to")
+    arguments = parser.parse_args()
+    logging.basicConfig(
+        format="%(levelname)s | %(asctime)s | %(name)s | %(message)s", level=logging.WARNING
+    )
+    _logger.setLevel(logging.INFO)
+    load_test_report = run(
+        rate=arguments.rate,
+        messages=arguments.messages,
+        consumers=arguments.consumers,
+        sizes=arguments.sizes,
+        models=arguments.models,
+        forecast_size=arguments.forecast_size,
+        seed=arguments.seed,
+    )
+    serialized_report = ujson.dumps(load_test_report, indent=2)
+    if arguments.output:
+        with open(arguments.output, "w") as report_file:
+            report_file.write(serialized_report)
+    sys.stdout.write(serialized_report + "\n")
@@ -18,11 +18,64 @@ class BaseModel(pydantic.BaseModel):
         smart_union = True
 
 
-class ForecastQuery(BaseModel):
-    """A model describing, how the incoming request shall look like"""
+def _check_keys(keys: list[str]) -> None:
+    """
+    Check if the keys are present in the database
+
+    :param keys: The municipal and district keys
+    """
+    shape_query = sql.select(
+        [database.tables.shapes.c.key],
+        database.tables.shapes.c.key.in_(keys),
+    )
+    db_shapes = {row[0] for row in database.engine.execute(shape_query).all()}
+    unrecognized_keys = [k for k in keys if k not in db_shapes]
+    if len(unrecognized_keys) > 0:
+        raise ValueError(
+            f"The following keys have not been recognized by the module: {unrecognized_keys}"
+        )
+
+
+def _check_consumer_groups(consumer_groups: typing.Optional[list[str]]) -> list[str]:
+    """
+    Check if the consumer groups are present in the database
+
+    :param consumer_groups: The external identifiers of the consumer groups or ``None`` to select
+        all consumer groups
+    :return: The external identifiers of the selected consumer groups
+    """
+    if consumer_groups is None:
+        consumer_group_pull_query = sql.select([database.tables.usage_types.c.external_identifier])
+        results = database.engine.execute(consumer_group_pull_query).all()
+        return [row[0] for row in results]
+    consumer_group_query = sql.select(
+        [database.tables.usage_types.c.external_identifier],
+        database.tables.usage_types.c.external_identifier.in_(consumer_groups),
+    )
+    results = database.engine.execute(consumer_group_query).all()
+    found_objects = [row[0] for row in results]
+    for obj in consumer_groups:
+        if obj not in found_objects:
+            raise ValueError(f"The consumer group {obj} was not found in the database")
+    return consumer_groups
+
+
+class ForecastParameters(BaseModel):
+    """
+    The parameters of a forecast query
+
+    The keys and consumer groups are only checked against the database by the subclasses, so a
+    batch of queries is checked with a single lookup
+    """
 
     model: enums.ForecastModel = pydantic.Field(default=..., alias="model")
-    """The forecast model which shall be used to forecast the usage values"""
+    """
+    The forecast model which shall be used to forecast the usage values
+
+    The ``auto`` model fits every other model and uses the one with the best adjusted R² score for
+    each series. Models with as many coefficients as a series has usages are not fitted, and
+    series with less than three usages are forecasted with the linear model
+    """
 
     keys: list[str] = pydantic.Field(default=..., alias="keys")
     """The municipal and district keys for which objects the forecast shall be executed"""
@@ -35,6 +88,69 @@ class ForecastQuery(BaseModel):
     forecast_size: int = pydantic.Field(default=20, alias="forecastSize", gt=0)
     """The amount of years for which the forecast shall be calculated"""
 
+    accept_encoding: enums.ContentEncoding = pydantic.Field(
+        default=enums.ContentEncoding.IDENTITY, alias="acceptEncoding"
+    )
+    """The content encoding in which the reply shall be compressed if it is large enough"""
+
+    accumulation_levels: list[enums.ForecastGranularity] = pydantic.Field(
+        default=[], alias="accumulationLevels"
+    )
+    """The levels of areas into which the forecasts shall be rolled up additionally"""
+
+    include_partials: bool = pydantic.Field(default=True, alias="includePartials")
+    """Whether the forecasts of every municipal and consumer group shall be returned"""
+
+    response_mode: enums.ResponseMode = pydantic.Field(
+        default=enums.ResponseMode.FULL, alias="responseMode"
+    )
+    """
+    The way the forecasts of every municipal and consumer group shall be returned
+
+    The ``coefficients`` mode returns the fitted curves instead of the forecasted values
+    """
+
+    include_reference: bool = pydantic.Field(default=True, alias="includeReference")
+    """Whether the reference values of every municipal and consumer group shall be returned"""
+
+    interval_quantiles: typing.Optional[list[float]] = pydantic.Field(
+        default=None, alias="intervalQuantiles"
+    )
+    """The quantiles of the prediction intervals which shall be returned with the forecasts"""
+
+    interval_resamples: int = pydantic.Field(
+        default=500, alias="intervalResamples", gt=0, le=10_000
+    )
+    """The number of bootstrap resamples used to calculate the prediction intervals"""
+
+    @pydantic.validator("interval_quantiles")
+    def check_interval_quantiles(cls, v):
+        """
+        Check if the quantiles of the prediction intervals lie between zero and one
+
+        :param v: The requested quantiles
+        :return: The requested quantiles
+        """
+        if v is not None and any(not 0 <= quantile <= 1 for quantile in v):
+            raise ValueError("The quantiles of the prediction intervals need to be within [0, 1]")
+        return v
+
+    @pydantic.root_validator(skip_on_failure=True)
+    def check_interval_response_mode(cls, values):
+        """
+        Check if the prediction intervals are requested together with the forecasted values
+        """
+        if (
+            values.get("interval_quantiles") is not None
+            and values.get("response_mode") is enums.ResponseMode.COEFFICIENTS
+        ):
+            raise ValueError("Prediction intervals are only returned in the full response mode")
+        return values
+
+
+class ForecastQuery(ForecastParameters):
+    """A model describing, how the incoming request shall look like"""
+
     @pydantic.validator("keys")
     def check_keys(cls, v):
         """
@@ -45,36 +161,60 @@ class ForecastQuery(BaseModel):
         """
         if v is None:
             raise ValueError("At least one key needs to be present in the list of keys")
-        # Now check if the keys are present in the database
-        shape_query = sql.select(
-            [database.tables.shapes.c.key],
-            database.tables.shapes.c.key.in_(v),
-        )
-        db_shapes = database.engine.execute(shape_query).all()
-        unrecognized_keys = [k for k in v if (k,) not in db_shapes]
-        if len(unrecognized_keys) > 0:
-            raise ValueError(
-                f"The following keys have not been recognized by the module: {unrecognized_keys}"
-            )
+        _check_keys(v)
         return v
 
     @pydantic.validator("consumer_groups", always=True)
     def check_consumer_groups(cls, v):
-        if v is None:
-            consumer_group_pull_query = sql.select([database.tables.usage_types.c.external_identifier])
-            results = database.engine.execute(consumer_group_pull_query).all()
-            return [row[0] for row in results]
-        else:
-            consumer_group_query = sql.select(
-                [database.tables.usage_types.c.external_identifier],
-                database.tables.usage_types.c.external_identifier.in_(v),
+        return _check_consumer_groups(v)
+
+
+class BatchForecastQuery(BaseModel):
+    """A model describing a batch of forecast queries which are answered in a single response"""
+
+    queries: list[ForecastParameters] = pydantic.Field(default=..., alias="queries", min_items=1)
+    """
+    The forecast queries which shall be answered. Their usage data is pulled only once
+
+    The content encodings requested by the queries are ignored in favour of the encoding
+    requested by the batch
+    """
+
+    accept_encoding: enums.ContentEncoding = pydantic.Field(
+        default=enums.ContentEncoding.IDENTITY, alias="acceptEncoding"
+    )
+    """The content encoding in which the reply shall be compressed if it is large enough"""
+
+    @pydantic.root_validator(skip_on_failure=True)
+    def check_queries(cls, values):
+        """
+        Check the keys and consumer groups of all queries against the database at once
+
+        The queries without consumer groups are set to all consumer groups
+        """
+        queries = values.get("queries")
+        _check_keys(list(dict.fromkeys(key for query in queries for key in query.keys)))
+        requested_consumer_groups = list(
+            dict.fromkeys(
+                consumer_group
+                for query in queries
+                if query.consumer_groups is not None
+                for consumer_group in query.consumer_groups
             )
-            results = database.engine.execute(consumer_group_query).all()
-            found_objects = [row[0] for row in results]
-            for obj in v:
-                if obj not in found_objects:
-                    raise ValueError(f"The consumer group {obj} was not found in the database")
-            return v
+        )
+        if any(query.consumer_groups is None for query in queries):
+            all_consumer_groups = _check_consumer_groups(None)
+            for consumer_group in requested_consumer_groups:
+                if consumer_group not in all_consumer_groups:
+                    raise ValueError(
+                        f"The consumer group {consumer_group} was not found in the database"
+                    )
+            for query in queries:
+                if query.consumer_groups is None:
+                    query.consumer_groups = list(all_consumer_groups)
+        else:
+            _check_consumer_groups(requested_consumer_groups)
+        return values
 
 
 class Usages(BaseModel):
@@ -87,6 +227,12 @@ class Usages(BaseModel):
     amounts: list[float] = pydantic.Field(default=..., alias="amounts")
     """The usage amounts from each year, ordered in a ascending manner"""
 
+    bands: typing.Optional[dict[str, list[float]]] = pydantic.Field(default=None, alias="bands")
+    """The quantiles of the bootstrapped forecasts from each year, keyed by their quantile"""
+
+    resamples: typing.Optional[int] = pydantic.Field(default=None, alias="resamples")
+    """The number of bootstrap resamples the bands have been calculated from"""
+
     @pydantic.root_validator
     def check_years(cls, values):
         """
@@ -136,6 +282,31 @@ class ConsumerGroup(BaseModel):
     """The name of the municipal"""
 
 
+class Curve(BaseModel):
+    """
+    A polynomial fitted to the reference values
+
+    The polynomial is evaluated by mapping a year linearly from the domain onto the window and
+    applying the coefficients to the mapped value. For the logarithmic model the natural
+    logarithm of the year is mapped instead of the year itself
+    """
+
+    coefficients: list[float] = pydantic.Field(default=..., alias="coefficients")
+    """The coefficients of the polynomial, ordered by ascending degree"""
+
+    domain: list[float] = pydantic.Field(default=..., alias="domain")
+    """The interval of the years which is mapped onto the window"""
+
+    window: list[float] = pydantic.Field(default=..., alias="window")
+    """The interval onto which the years are mapped"""
+
+    start: int = pydantic.Field(default=..., alias="start")
+    """The first year of the forecast"""
+
+    end: int = pydantic.Field(default=..., alias="end")
+    """The last year of the forecast"""
+
+
 class Forecast(BaseModel):
 
     model: enums.ForecastModel = pydantic.Field(default=..., alias="model")
@@ -147,7 +318,16 @@ class Forecast(BaseModel):
     score: float = pydantic.Field(default=..., alias="float")
     """The R² score of the forecast"""
 
-    usages: Usages = pydantic.Field(default=..., alias="usages")
+    scores: typing.Optional[dict[enums.ForecastModel, float]] = pydantic.Field(
+        default=None, alias="scores"
+    )
+    """The adjusted R² scores of the ranked models, if the model has been selected automatically"""
+
+    usages: typing.Optional[Usages] = pydantic.Field(default=None, alias="usages")
+    """The forecasted usage values, if the full response mode has been requested"""
+
+    curve: typing.Optional[Curve] = pydantic.Field(default=None, alias="curve")
+    """The fitted curve, if the coefficients response mode has been requested"""
 
 
 class ForecastResult(BaseModel):
@@ -155,7 +335,9 @@ class ForecastResult(BaseModel):
     forecast: Forecast = pydantic.Field(default=..., alias="forecast")
     """The usage values that have been forecasted"""
 
-    reference_usages: Usages = pydantic.Field(default=..., alias="referenceUsages")
+    reference_usages: typing.Optional[Usages] = pydantic.Field(
+        default=None, alias="referenceUsages"
+    )
     """The usage values on which the model has been built"""
 
     municipal: Municipal = pydantic.Field(default=..., alias="municipal")
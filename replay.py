@@ -0,0 +1,157 @@
+"""Replay of captured forecast requests through the executor with diffable reply digests"""
+import argparse
+import gzip
+import hashlib
+import logging
+import pathlib
+import sys
+import time
+import typing
+
+import numpy
+import ujson
+import zstandard
+
+import capture
+import loadtest
+import server_functions
+import settings
+
+_logger = logging.getLogger("replay")
+
+_GZIP_MAGIC = b"\x1f\x8b"
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def _decode_reply(reply: bytes) -> typing.Any:
+    """Decompress the reply if it has been compressed and parse the JSON document"""
+    if reply.startswith(_GZIP_MAGIC):
+        reply = gzip.decompress(reply)
+    elif reply.startswith(_ZSTD_MAGIC):
+        reply = zstandard.ZstdDecompressor().decompressobj().decompress(reply)
+    return ujson.loads(reply)
+
+
+def _canonicalize(value: typing.Any, precision: int) -> typing.Any:
+    """
+    Bring the parsed reply into a canonical form which does not depend on the processing order
+
+    Numbers are rounded to the significant digits and lists of objects, e.g. the partial
+    forecasts, are sorted by their serialized form. Lists of numbers keep their order, since the
+    order of the usage values is meaningful
+
+    :param value: The parsed reply or a part of it
+    :param precision: The number of significant digits of the numbers
+    :return: The canonical form of the value
+    """
+    if isinstance(value, float):
+        return float(f"{value:.{precision}g}")
+    if isinstance(value, dict):
+        return {key: _canonicalize(item, precision) for key, item in value.items()}
+    if isinstance(value, list):
+        items = [_canonicalize(item, precision) for item in value]
+        if len(items) > 0 and all(isinstance(item, dict) for item in items):
+            items.sort(key=lambda item: ujson.dumps(item, sort_keys=True))
+        return items
+    return value
+
+
+def digest_reply(reply: bytes, precision: int) -> str:
+    """
+    Get a digest of the reply which only changes if the content of the reply changes
+
+    :param reply: The serialized and possibly compressed reply
+    :param precision: The number of significant digits the numbers are compared with
+    :return: The SHA-256 digest of the canonical form of the reply
+    """
+    canonical_reply = _canonicalize(_decode_reply(reply), precision)
+    return hashlib.sha256(ujson.dumps(canonical_reply, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def replay(
+    records: list[dict],
+    speed: typing.Optional[float],
+    consumers: int,
+    precision: int,
+) -> tuple[list[dict], dict]:
+    """
+    Publish the captured messages onto an in-process broker in the order they were received
+
+    :param records: The captured messages
+    :param speed: The factor by which the gaps between the messages are shortened or ``None`` to
+        publish all messages at once
+    :param consumers: The number of consumers handling the messages concurrently
+    :param precision: The number of significant digits the numbers of the replies are compared with
+    :return: The digest of every reply and the report of the replay
+    """
+    broker = loadtest.InProcessBroker(
+        server_functions.content_validator,
+        server_functions.executor,
+        consumers,
+        reply_handler=lambda reply: digest_reply(reply, precision),
+    )
+    broker.start()
+    _logger.info("Replaying %s captured messages", len(records))
+    start = time.perf_counter()
+    for record in records:
+        if speed is not None:
+            scheduled = start + (record["timestamp"] - records[0]["timestamp"]) / speed
+            time.sleep(max(scheduled - time.perf_counter(), 0))
+        broker.publish(record["body"].encode("utf-8"), "valid" if record["valid"] else "invalid")
+    broker.join()
+    report = loadtest.build_report(broker.deliveries, time.perf_counter() - start)
+    captured_times = [
+        (record["validationTime"] or 0) + (record["executionTime"] or 0) for record in records
+    ]
+    report["capturedServiceTime"] = loadtest.summarize_durations(numpy.array(captured_times))
+    digests = [
+        {
+            "index": index,
+            "timestamp": record["timestamp"],
+            "status": delivery.status,
+            "digest": delivery.result,
+        }
+        for index, (record, delivery) in enumerate(zip(records, broker.deliveries))
+    ]
+    return digests, report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        epilog="Set CONFIG_SNAPSHOT_DIRECTORY to replay against a local usage data snapshot",
+    )
+    parser.add_argument("capture", type=pathlib.Path, help="capture file written by the service")
+    parser.add_argument("digests", type=pathlib.Path, help="file the reply digests are written to")
+    pacing = parser.add_mutually_exclusive_group()
+    pacing.add_argument("--speed", type=float, default=1.0, help="acceleration of the arrivals")
+    pacing.add_argument("--unpaced", action="store_true", help="publish all messages at once")
+    parser.add_argument("--consumers", type=int, default=1, help="concurrent consumers")
+    parser.add_argument("--precision", type=int, default=10, help="compared significant digits")
+    parser.add_argument("--limit", type=int, help="number of captured messages replayed")
+    parser.add_argument("--report", type=pathlib.Path, help="file the JSON report is written to")
+    arguments = parser.parse_args()
+    logging.basicConfig(
+        format="%(levelname)s | %(asctime)s | %(name)s | %(message)s", level=logging.WARNING
+    )
+    _logger.setLevel(logging.INFO)
+    if settings.SnapshotSettings().directory is None:
+        _logger.warning("No snapshot directory is configured. Replaying against the database")
+    captured_records = capture.read(arguments.capture)[: arguments.limit]
+    if len(captured_records) == 0:
+        _logger.critical("The capture %s contains no messages", arguments.capture)
+        sys.exit(1)
+    reply_digests, replay_report = replay(
+        captured_records,
+        None if arguments.unpaced else arguments.speed,
+        arguments.consumers,
+        arguments.precision,
+    )
+    with open(arguments.digests, "w") as digest_file:
+        for reply_digest in reply_digests:
+            digest_file.write(ujson.dumps(reply_digest) + "\n")
+    serialized_report = ujson.dumps(replay_report, indent=2)
+    if arguments.report:
+        with open(arguments.report, "w") as report_file:
+            report_file.write(serialized_report)
+    sys.stdout.write(serialized_report + "\n")
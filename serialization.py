@@ -0,0 +1,126 @@
+"""Serialization of the replies sent by the service"""
+import gzip
+import io
+import typing
+
+import ujson
+import zstandard
+
+import enums
+
+_FLUSH_SIZE = 65536
+"""The number of bytes which are collected before they are passed to the compressor"""
+
+
+def dump_reply(reply: dict, encoding: enums.ContentEncoding, threshold: int) -> bytes:
+    """
+    Serialize the reply into a JSON document encoded with the requested content encoding
+
+    The reply is serialized in chunks which are passed to the compressor one by one, so the
+    uncompressed document is never held in memory completely. Replies smaller than the threshold
+    are returned uncompressed. Clients may tell compressed replies apart by the magic bytes of
+    the gzip and zstd formats, since a JSON document always starts with ``{``
+
+    :param reply: The reply which shall be serialized
+    :param encoding: The content encoding requested by the client
+    :param threshold: The size in bytes from which on replies are compressed
+    :return: The serialized reply
+    """
+    if encoding is enums.ContentEncoding.IDENTITY:
+        return ujson.dumps(reply, ensure_ascii=False, sort_keys=False).encode("utf-8")
+    writer = _ReplyWriter(encoding, threshold)
+    for chunk in _iterate_chunks(reply):
+        writer.write(chunk.encode("utf-8"))
+    return writer.getvalue()
+
+
+def _is_flat(items: typing.Iterable) -> bool:
+    """Check if the items contain no objects and no lists other than lists of plain values"""
+    return all(
+        not isinstance(item, dict)
+        and not (isinstance(item, list) and any(isinstance(i, (dict, list)) for i in item))
+        for item in items
+    )
+
+
+def _contains_records(value: dict) -> bool:
+    """Check if a value of the object is a list of objects, e.g. the partials of a result"""
+    return any(
+        isinstance(item, list) and any(isinstance(i, dict) for i in item) for item in value.values()
+    )
+
+
+def _iterate_chunks(value: typing.Any, record: bool = False) -> typing.Iterator[str]:
+    """
+    Serialize the value into consecutive chunks of a JSON document
+
+    Objects and lists are split into separate chunks regardless of how deeply they are nested.
+    The objects within a list, e.g. the partials of a query, are serialized as a single chunk
+    unless they contain lists of objects themselves, and all other objects and lists are split
+    until they only contain plain values. Therefore, the size of a chunk does not depend on the
+    number of partials or queries in the reply
+
+    :param value: The value which shall be serialized
+    :param record: Whether the value is an element of a list
+    :return: The chunks of the serialized value
+    """
+    if isinstance(value, dict) and (
+        _contains_records(value) if record else not _is_flat(value.values())
+    ):
+        yield "{"
+        for index, (key, item) in enumerate(value.items()):
+            yield ("," if index > 0 else "") + ujson.dumps(key, ensure_ascii=False) + ":"
+            yield from _iterate_chunks(item)
+        yield "}"
+    elif isinstance(value, list) and not _is_flat(value):
+        yield "["
+        for index, item in enumerate(value):
+            if index > 0:
+                yield ","
+            yield from _iterate_chunks(item, record=True)
+        yield "]"
+    else:
+        yield ujson.dumps(value, ensure_ascii=False, sort_keys=False)
+
+
+class _ReplyWriter:
+    """
+    A writer which buffers the chunks of a reply until the threshold is reached and compresses
+    all following chunks in blocks of the flush size
+    """
+
+    def __init__(self, encoding: enums.ContentEncoding, threshold: int):
+        self._encoding = encoding
+        self._threshold = threshold
+        self._pending_chunks: list[bytes] = []
+        self._pending_size = 0
+        self._output = io.BytesIO()
+        self._compressor: typing.Optional[typing.BinaryIO] = None
+
+    def write(self, chunk: bytes) -> None:
+        self._pending_chunks.append(chunk)
+        self._pending_size += len(chunk)
+        if self._compressor is None and self._pending_size >= self._threshold:
+            self._compressor = self._open_compressor()
+        if self._compressor is not None and self._pending_size >= _FLUSH_SIZE:
+            self._flush()
+
+    def _flush(self) -> None:
+        self._compressor.write(b"".join(self._pending_chunks))
+        self._pending_chunks.clear()
+        self._pending_size = 0
+
+    def _open_compressor(self) -> typing.BinaryIO:
+        if self._encoding is enums.ContentEncoding.GZIP:
+            return gzip.GzipFile(fileobj=self._output, mode="wb", compresslevel=6)
+        if self._encoding is enums.ContentEncoding.ZSTD:
+            return zstandard.ZstdCompressor().stream_writer(self._output, closefd=False)
+        raise ValueError(f"The content encoding {self._encoding} is not supported")
+
+    def getvalue(self) -> bytes:
+        """Finish the reply and get its serialized content"""
+        if self._compressor is None:
+            return b"".join(self._pending_chunks)
+        self._flush()
+        self._compressor.close()
+        return self._output.getvalue()
@@ -0,0 +1,131 @@
+"""Compact representation of the usage series handled by the service"""
+import typing
+
+import numpy
+import numpy.polynomial
+
+import enums
+
+
+class UsageSeries:
+    """
+    The yearly usage values of a single municipal and consumer group
+
+    The reference and forecast values are stored as contiguous ``float64`` arrays, which are
+    only converted into plain lists once the response is serialized
+    """
+
+    __slots__ = (
+        "municipal",
+        "consumer_group",
+        "start_year",
+        "end_year",
+        "reference",
+        "model",
+        "curve",
+        "forecast",
+        "score",
+        "scores",
+        "bands",
+        "resamples",
+    )
+
+    def __init__(
+        self,
+        municipal: str,
+        consumer_group: typing.Any,
+        start_year: int,
+        end_year: int,
+        reference: numpy.ndarray,
+    ):
+        self.municipal = municipal
+        """The official municipal key of the municipal the usages belong to"""
+
+        self.consumer_group = consumer_group
+        """The database id of the consumer group the usages belong to"""
+
+        self.start_year = start_year
+        """The year of the first reference value"""
+
+        self.end_year = end_year
+        """The year of the last reference value"""
+
+        self.reference = reference
+        """The reference usage values ordered ascending by their year"""
+
+        self.model: typing.Optional[enums.ForecastModel] = None
+        """The model which has been used to calculate the forecast"""
+
+        self.curve: typing.Optional[numpy.polynomial.Polynomial] = None
+        """The curve fitted to the reference values"""
+
+        self.forecast: typing.Optional[numpy.ndarray] = None
+        """The forecasted usage values ordered ascending by their year"""
+
+        self.score: typing.Optional[float] = None
+        """The R² score of the fitted curve"""
+
+        self.scores: typing.Optional[dict[enums.ForecastModel, float]] = None
+        """The adjusted R² scores of the models ranked while selecting the model automatically"""
+
+        self.bands: typing.Optional[dict[float, numpy.ndarray]] = None
+        """The quantiles of the bootstrapped forecasts, if prediction intervals were requested"""
+
+        self.resamples: typing.Optional[int] = None
+        """The number of bootstrap resamples the bands have been calculated from"""
+
+    def copy(self) -> "UsageSeries":
+        """Create an uncalculated series of the same usages sharing the reference values"""
+        return UsageSeries(
+            municipal=self.municipal,
+            consumer_group=self.consumer_group,
+            start_year=self.start_year,
+            end_year=self.end_year,
+            reference=self.reference,
+        )
+
+    @property
+    def reference_end(self) -> int:
+        """The year of the last value in the reference array"""
+        return self.start_year + len(self.reference) - 1
+
+    @property
+    def forecast_start(self) -> int:
+        """The year of the first forecasted value"""
+        return self.end_year + 1
+
+
+def from_usage_rows(rows: typing.Sequence) -> list[UsageSeries]:
+    """
+    Split the rows returned by the usage data query into usage series
+
+    The rows need to consist of the municipal, the consumer group, the date or year and the summed
+    amount and need to be ordered by the municipal, the consumer group and the date. All series
+    share a single amount buffer and only hold views onto it.
+
+    :param rows: The rows returned by the usage data query
+    :return: The usage series contained in the rows
+    """
+    if len(rows) == 0:
+        return []
+    municipals, consumer_groups, dates, amounts = zip(*rows)
+    municipals = numpy.array(municipals, dtype=object)
+    consumer_groups = numpy.array(consumer_groups, dtype=object)
+    amounts = numpy.asarray(amounts, dtype=numpy.float64)
+    years = numpy.fromiter(
+        (getattr(date, "year", date) for date in dates), dtype=numpy.int64, count=len(rows)
+    )
+    # %% Find the rows at which a new municipal or consumer group starts
+    changes = (municipals[1:] != municipals[:-1]) | (consumer_groups[1:] != consumer_groups[:-1])
+    starts = numpy.concatenate(([0], numpy.flatnonzero(changes) + 1))
+    ends = numpy.concatenate((starts[1:], [len(rows)]))
+    return [
+        UsageSeries(
+            municipal=municipals[start],
+            consumer_group=consumer_groups[start],
+            start_year=int(years[start]),
+            end_year=int(years[end - 1]),
+            reference=amounts[start:end],
+        )
+        for start, end in zip(starts, ends)
+    ]
@@ -1,153 +1,490 @@
 """Module containing functions for the AMQP server"""
+import collections
 import concurrent.futures
+import itertools
 import logging
-import time
+import threading
+import typing
 
-import pandas
+import pydantic
 import pydantic.error_wrappers
 import sqlalchemy
-import ujson
 from sqlalchemy.sql import *
 from sqlalchemy.sql.functions import sum as sum_
 
 import database
+import database.snapshot
 import database.tables
+import enums
 import functions
 import models
+import serialization
+import series
+import settings
 import tools
 
 _validator_logger = logging.getLogger("content_validator")
 _executor_logger = logging.getLogger("executor")
 
+_service_settings = settings.ServiceSettings()
+_snapshot_settings = settings.SnapshotSettings()
+_database_settings = settings.DatabaseSettings()
+
+_parsed_messages = threading.local()
+"""The last message accepted by the content validator on a thread and the request parsed from it"""
+
 
 def content_validator(message: bytes) -> bool:
     """Check if the content is parseable by the pydantic data model"""
     try:
-        models.ForecastQuery.parse_raw(message)
+        request = _parse_message(message)
+        _parsed_messages.message = message
+        _parsed_messages.request = request
         return True
     except pydantic.error_wrappers.ValidationError as e:
         _validator_logger.critical("Unable to parse message. Rejecting the message", exc_info=e)
         return False
 
 
-def executor(message: bytes) -> bytes:
-    """Parse the message and run the appropriate actions"""
-    request: models.ForecastQuery = models.ForecastQuery.parse_raw(message)
-    # %% Get the municipals which are within the districts
-    regex = r""
-    for key in request.keys:
-        if len(key) < 12:
-            regex += rf"^{key}\d+$|"
-        else:
-            regex += rf"^{key}$|"
-    regex = regex.strip("|")
-    # %% Get the municipals within a district
+def _parse_message(
+    message: bytes,
+) -> typing.Union[models.BatchForecastQuery, models.ForecastQuery]:
+    """Parse the message either as a batch of forecast queries or as a single forecast query"""
+    return pydantic.parse_raw_as(
+        typing.Union[models.BatchForecastQuery, models.ForecastQuery], message
+    )
+
+
+def _take_parsed_message(
+    message: bytes,
+) -> typing.Union[models.BatchForecastQuery, models.ForecastQuery]:
+    """
+    Get the request the content validator parsed from the message or parse the message again
+
+    The validators of the queries look up the keys and consumer groups in the database, so the
+    request is not parsed twice. The consumer of the ``amqp_rpc_server`` package calls the content
+    validator and the executor for a delivery on the same thread, so the parsed request is handed
+    over in a thread-local storage and removed from it once it has been taken
+
+    :param message: The message passed to the executor
+    :return: The request contained in the message
+    """
+    parsed_message = getattr(_parsed_messages, "message", None)
+    request = getattr(_parsed_messages, "request", None)
+    _parsed_messages.message = None
+    _parsed_messages.request = None
+    if request is None or (parsed_message is not message and parsed_message != message):
+        return _parse_message(message)
+    return request
+
+
+def _escape_like(value: str) -> str:
+    """Escape the wildcards of a ``LIKE`` pattern with the default escape character of PostgreSQL"""
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _resolve_municipals(keys: typing.Iterable[str]) -> dict:
+    """
+    Get the municipals which are identified by the keys or lie within them
+
+    The names and NUTS keys of the municipals are pulled in the same query, so resolving the
+    municipals only takes a single round-trip to the database. District keys are matched as
+    fixed prefixes, which lets PostgreSQL answer the lookup from the ``text_pattern_ops`` index
+    on the keys
+
+    :param keys: The municipal and district keys
+    :return: A mapping of the official municipal keys to the names, keys and NUTS keys of the
+        municipals
+    """
+    key_column = database.tables.shapes.c.key
+    key_conditions = [
+        key_column == key if len(key) >= 12 else key_column.like(f"{_escape_like(key)}%")
+        for key in keys
+    ]
     municipal_query = select(
-        [database.tables.shapes.c.key],
+        [
+            database.tables.shapes.c.name,
+            database.tables.shapes.c.key,
+            database.tables.shapes.c.nuts_key,
+        ],
         sqlalchemy.and_(
-            database.tables.shapes.c.key.regexp_match(regex),
-            sqlalchemy.func.length(database.tables.shapes.c.key) == 12,
+            sqlalchemy.or_(*key_conditions),
+            sqlalchemy.func.length(key_column) == 12,
         ),
     )
     results = database.engine.execute(municipal_query).all()
-    municipal_keys = [res[0] for res in results]
-    _executor_logger.debug("GOT keys: %s", municipal_keys)
-    # %% Get the primary keys for the municipals
-    municipal_keys = list(set(municipal_keys))
-    # %% Convert the Consumer Groups into ids
-    usage_type_id_query = select(
-        [database.tables.usage_types.c.id],
-        database.tables.usage_types.c.external_identifier.in_(request.consumer_groups),
-    )
-    cg_results = database.engine.execute(usage_type_id_query).all()
-    usage_type_ids = [row[0] for row in cg_results]
-    # %% Get the water usage data for every municipal and consumer group
-    data_query = select(
-        [
+    municipals = {res[1]: (res[0], res[1], res[2]) for res in results}
+    _executor_logger.debug("GOT keys: %s", list(municipals))
+    return municipals
+
+
+def _fetch_usage_series(municipal_keys: list, usage_type_ids: list) -> list[series.UsageSeries]:
+    """
+    Get the usage series of the municipals and consumer groups
+
+    The series are read from the local snapshot if one is configured and has already been
+    synchronized. Otherwise, they are pulled from the database, either from the yearly rollup
+    table if its usage is enabled or from the usages table
+
+    :param municipal_keys: The official municipal keys of the municipals
+    :param usage_type_ids: The database ids of the consumer groups
+    :return: The usage series of the municipals and consumer groups
+    """
+    if _snapshot_settings.directory is not None:
+        snapshot = database.snapshot.load(_snapshot_settings.directory)
+        if snapshot is not None:
+            _executor_logger.info("Reading water usage data from the local snapshot")
+            return snapshot.read_series(municipal_keys, usage_type_ids)
+    if _database_settings.use_yearly_rollup:
+        usages_yearly = database.tables.usages_yearly
+        rollup_query = select(
+            [
+                usages_yearly.c.municipality,
+                usages_yearly.c.usage_type,
+                usages_yearly.c.year,
+                usages_yearly.c.amount,
+            ],
+            sqlalchemy.and_(
+                usages_yearly.c.municipality.in_(municipal_keys),
+                usages_yearly.c.usage_type.in_(usage_type_ids),
+            ),
+        ).order_by(
+            usages_yearly.c.municipality,
+            usages_yearly.c.usage_type,
+            usages_yearly.c.year,
+        )
+        _executor_logger.info("Pulling water usage data from the yearly rollup")
+        return series.from_usage_rows(database.engine.execute(rollup_query).all())
+    data_query = (
+        select(
+            [
+                database.tables.usages.c.municipality,
+                database.tables.usages.c.usage_type,
+                database.tables.usages.c.date,
+                sum_(database.tables.usages.c.amount),
+            ],
+            sqlalchemy.and_(
+                database.tables.usages.c.municipality.in_(municipal_keys),
+                database.tables.usages.c.usage_type.in_(usage_type_ids),
+            ),
+        )
+        .group_by(
             database.tables.usages.c.municipality,
             database.tables.usages.c.usage_type,
             database.tables.usages.c.date,
-            sum_(database.tables.usages.c.amount),
-        ],
-        sqlalchemy.and_(
-            database.tables.usages.c.municipality.in_(municipal_keys),
-            database.tables.usages.c.usage_type.in_(usage_type_ids),
-        ),
-    ).group_by(
-        database.tables.usages.c.municipality,
-        database.tables.usages.c.usage_type,
-        database.tables.usages.c.date,
+        )
+        .order_by(
+            database.tables.usages.c.municipality,
+            database.tables.usages.c.usage_type,
+            database.tables.usages.c.date,
+        )
     )
     _executor_logger.info("Pulling water usage data")
     data_query_results = database.engine.execute(data_query).all()
-    usage_data = pandas.DataFrame(data_query_results)
-    _executor_logger.info("Grouping the water usage data by their municipals")
-    municipal_usage_data = dict(tuple(usage_data.groupby("municipality")))
-    forecast_results = []
-    single_forecast_responses = []
-    municipals = tools.get_municipal_names_from_query(municipal_keys)
-    consumer_groups = tools.get_consumer_group_names_from_query(usage_type_ids)
-    inverted_municipals = tools.get_inverted_municipal_mapping(municipals)
-    inverted_consumer_groups = tools.get_inverted_consumer_group_mapping(consumer_groups)
-    municipal_accumulation = {}
-    consumer_group_accumulation = {}
-    with concurrent.futures.ThreadPoolExecutor() as tpe:
-        forecast_parameters = []
-        for municipal, data in municipal_usage_data.items():
-            for consumer_group, data in dict(tuple(data.groupby("usage_type"))).items():
-                usages = []
-                years = []
-                data: pandas.DataFrame
-                data = data.sort_values(["date"])
-                for v in data["sum_1"]:
-                    usages.append(v)
-                for v in data["date"]:
-                    years.append(v.year)
-                years = sorted(years)
-                forecast_parameters.append(
-                    {
-                        "result_list": forecast_results,
-                        "consumer_group": consumer_group,
-                        "model": request.model,
-                        "usages": usages,
-                        "start_year": years[0],
-                        "end_year": years[-1],
-                        "forecast_size": request.forecast_size,
-                        "municipal": municipal,
-                    }
-                )
-        calc_threads = tpe.map(lambda args: functions.run_forecast(**args), forecast_parameters)
-        _executor_logger.info("Running forecasts in threads")
-        while len(forecast_results) < len(forecast_parameters):
-            time.sleep(0.05)
-        _executor_logger.info("Finished forecast calculation")
-        response_builder_threads = tpe.map(
-            lambda forecast_result: functions.build_response(
-                single_forecast_responses, request, municipals, consumer_groups, forecast_result
-            ),
-            forecast_results,
+    _executor_logger.info("Splitting the water usage data into series")
+    return series.from_usage_rows(data_query_results)
+
+
+def executor(message: bytes) -> bytes:
+    """Parse the message and run the appropriate actions"""
+    request = _take_parsed_message(message)
+    if isinstance(request, models.BatchForecastQuery):
+        _executor_logger.info("Answering a batch of %s queries", len(request.queries))
+        response = {"results": _answer_queries(request.queries)}
+    else:
+        response = _answer_queries([request])[0]
+    _executor_logger.info("Finished request handling. Returning response")
+    return serialization.dump_reply(
+        response, request.accept_encoding, _service_settings.compression_threshold
+    )
+
+
+def _get_area_names(
+    municipal_keys: list[str],
+    municipals: dict,
+    levels: set[enums.ForecastGranularity],
+) -> dict:
+    """
+    Get the display names of the areas into which the municipals will be rolled up
+
+    :param municipal_keys: The official municipal keys of the municipals
+    :param municipals: The mapping of the municipal keys to their names, keys and NUTS keys
+    :param levels: The levels into which the municipals will be rolled up
+    :return: A mapping of the area keys to the display names of the areas
+    """
+    if len(levels) == 0:
+        return {}
+    area_keys = set()
+    for level in levels:
+        area_keys.update(functions.rollup_keys(municipal_keys, municipals, level))
+    area_keys.discard(None)
+    return tools.get_area_names(area_keys)
+
+
+def _calculation_key(query: models.ForecastParameters, series_count: int) -> tuple:
+    """
+    Get the parameters of the query which determine the calculated values of a series
+
+    :param query: The forecast query
+    :param series_count: The number of series requested by the query, which determines the
+        number of bootstrap resamples of the prediction intervals
+    :return: The parameters determining the calculated values
+    """
+    if query.interval_quantiles is None:
+        return query.model, query.forecast_size
+    return (
+        query.model,
+        query.forecast_size,
+        tuple(query.interval_quantiles),
+        query.interval_resamples,
+        series_count,
+    )
+
+
+def _count_requested_series(
+    municipal_keys: list[str], queries: list[models.ForecastParameters]
+) -> list[int]:
+    """
+    Count the series requested by every query before any usage data is pulled
+
+    :param municipal_keys: The official municipal keys of the requested municipals
+    :param queries: The forecast queries
+    :return: The number of municipals and consumer groups selected by every query
+    """
+    return [
+        sum(municipal_key.startswith(tuple(query.keys)) for municipal_key in municipal_keys)
+        * len(query.consumer_groups)
+        for query in queries
+    ]
+
+
+def _shard_municipal_keys(
+    municipal_keys: list[str], consumer_group_count: int, shard_size: int
+) -> list[list]:
+    """
+    Split the municipals into shards whose number of series stays below the shard size
+
+    The municipals are grouped by their district, and districts are only split up if a single
+    district exceeds the shard size
+
+    :param municipal_keys: The official municipal keys of the requested municipals
+    :param consumer_group_count: The number of requested consumer groups
+    :param shard_size: The max. number of series in a shard
+    :return: The municipal keys of every shard
+    """
+    max_shard_keys = max(1, shard_size // max(1, consumer_group_count))
+    if len(municipal_keys) <= max_shard_keys:
+        return [municipal_keys]
+    districts = {}
+    for municipal_key in sorted(municipal_keys):
+        districts.setdefault(municipal_key[:5], []).append(municipal_key)
+    shards = [[]]
+    for district_keys in districts.values():
+        for offset in range(0, len(district_keys), max_shard_keys):
+            district_chunk = district_keys[offset : offset + max_shard_keys]
+            if len(shards[-1]) + len(district_chunk) > max_shard_keys:
+                shards.append([])
+            shards[-1].extend(district_chunk)
+    return shards
+
+
+def _calculate_series(
+    usage_series: list[series.UsageSeries],
+    queries: list[models.ForecastParameters],
+    series_counts: list[int],
+    usage_type_ids: dict,
+    tpe: concurrent.futures.Executor,
+) -> tuple[list[list[series.UsageSeries]], dict]:
+    """
+    Calculate the forecasts requested by the queries
+
+    :param usage_series: The usage series pulled for the queries
+    :param queries: The forecast queries which shall be answered
+    :param series_counts: The number of series requested by every query
+    :param usage_type_ids: The mapping of the consumer group identifiers to their database ids
+    :param tpe: The executor running the forecast calculations
+    :return: The series selected by every query and the calculated series per calculation key
+    """
+    # %% Select the series of every query and collect the distinct calculations
+    query_series = []
+    calculations = {}
+    for query, series_count in zip(queries, series_counts):
+        query_usage_type_ids = {usage_type_ids[identifier] for identifier in query.consumer_groups}
+        selected_series = [
+            s
+            for s in usage_series
+            if s.municipal.startswith(tuple(query.keys))
+            and s.consumer_group in query_usage_type_ids
+        ]
+        query_series.append(selected_series)
+        _, _, pending = calculations.setdefault(
+            _calculation_key(query, series_count), (query, series_count, {})
+        )
+        for s in selected_series:
+            pending.setdefault((s.municipal, s.consumer_group), s)
+    calculated_series = {}
+    for key, (query, series_count, pending) in calculations.items():
+        forecast_results = list(
+            tpe.map(
+                functions.run_forecast,
+                [s.copy() for s in pending.values()],
+                itertools.repeat(query.model),
+                itertools.repeat(query.forecast_size),
+            )
+        )
+        if query.interval_quantiles is not None:
+            _executor_logger.info("Bootstrapping the prediction intervals")
+            functions.calculate_prediction_intervals(
+                forecast_results,
+                query.interval_quantiles,
+                query.interval_resamples,
+                series_count,
+                _service_settings.bootstrap_budget,
+            )
+        calculated_series[key] = dict(zip(pending.keys(), forecast_results))
+    return query_series, calculated_series
+
+
+def _calculate_shard(
+    municipal_keys: list[str],
+    queries: list[models.ForecastParameters],
+    series_counts: list[int],
+    usage_type_ids: dict,
+    tpe: concurrent.futures.Executor,
+) -> tuple[list[list[series.UsageSeries]], dict]:
+    """Pull the usage data of the municipals and calculate the forecasts requested by the queries"""
+    usage_series = _fetch_usage_series(municipal_keys, list(usage_type_ids.values()))
+    return _calculate_series(usage_series, queries, series_counts, usage_type_ids, tpe)
+
+
+def _calculate_shards(
+    municipal_keys: list[str],
+    queries: list[models.ForecastParameters],
+    series_counts: list[int],
+    usage_type_ids: dict,
+    tpe: concurrent.futures.Executor,
+) -> typing.Iterator[tuple[list[list[series.UsageSeries]], dict]]:
+    """
+    Calculate the forecasts requested by the queries and yield the results shard by shard
+
+    In the pipelined execution mode, the municipals are split into chunks of districts and a
+    dedicated I/O thread pulls the usage data of the next chunk while the current chunk is
+    calculated. Otherwise, requests exceeding the shard size are split into shards which are
+    pulled and calculated in parallel. A shard is only started once a previous shard has been
+    consumed, so at most as many shards as there are shard workers are held in memory
+
+    :param municipal_keys: The official municipal keys of the requested municipals
+    :param queries: The forecast queries which shall be answered
+    :param series_counts: The number of series requested by every query
+    :param usage_type_ids: The mapping of the consumer group identifiers to their database ids
+    :param tpe: The executor running the forecast calculations
+    :return: The series selected by every query and the calculated series of every shard
+    """
+    if _service_settings.pipelined_execution:
+        chunks = _shard_municipal_keys(
+            municipal_keys, len(usage_type_ids), _service_settings.pipeline_chunk_size
         )
-        while len(single_forecast_responses) < len(forecast_parameters):
-            time.sleep(0.05)
-        _executor_logger.info("Finished partial response building")
-        municipal_accumulation_future = tpe.submit(
-            functions.accumulate_by_municipals, single_forecast_responses, inverted_municipals
+        _executor_logger.info("Pipelining the request in %s chunks", len(chunks))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as io_tpe:
+            next_fetch = io_tpe.submit(
+                _fetch_usage_series, chunks[0], list(usage_type_ids.values())
+            )
+            for index in range(len(chunks)):
+                usage_series = next_fetch.result()
+                if index + 1 < len(chunks):
+                    next_fetch = io_tpe.submit(
+                        _fetch_usage_series, chunks[index + 1], list(usage_type_ids.values())
+                    )
+                yield _calculate_series(usage_series, queries, series_counts, usage_type_ids, tpe)
+        return
+    shards = _shard_municipal_keys(
+        municipal_keys, len(usage_type_ids), _service_settings.shard_size
+    )
+    if len(shards) == 1:
+        yield _calculate_shard(shards[0], queries, series_counts, usage_type_ids, tpe)
+        return
+    _executor_logger.info("Splitting the request into %s shards", len(shards))
+    # only as many shards as there are workers are submitted, so the results of finished shards
+    # do not pile up while the previous shards are consumed
+    pending_shards = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=_service_settings.shard_workers
+    ) as shard_tpe:
+        for shard in shards:
+            if len(pending_shards) == _service_settings.shard_workers:
+                yield pending_shards.popleft().result()
+            pending_shards.append(
+                shard_tpe.submit(
+                    _calculate_shard, shard, queries, series_counts, usage_type_ids, tpe
+                )
+            )
+        while len(pending_shards) > 0:
+            yield pending_shards.popleft().result()
+
+
+def _answer_queries(queries: list[models.ForecastParameters]) -> list[dict]:
+    """
+    Answer the forecast queries using a single usage data fetch
+
+    The municipals and consumer groups of all queries are resolved together and their usage data
+    is pulled at once. Every series is calculated only once per model and forecast size, even if
+    it is requested by multiple queries. Large requests are pulled and calculated in shards,
+    whose results are added onto the accumulations as soon as they are available
+
+    :param queries: The forecast queries which shall be answered
+    :return: The responses to the queries in the order of the queries
+    """
+    # %% Resolve the municipals and consumer groups of all queries
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as lookup_executor:
+        municipals_future = lookup_executor.submit(
+            _resolve_municipals, {key for query in queries for key in query.keys}
         )
-        consumer_group_accumulation_future = tpe.submit(
-            functions.accumulate_by_consumer_groups,
-            single_forecast_responses,
-            inverted_consumer_groups,
+        consumer_groups_future = lookup_executor.submit(
+            tools.get_consumer_groups_by_identifiers,
+            {consumer_group for query in queries for consumer_group in query.consumer_groups},
         )
-        municipal_accumulation = municipal_accumulation_future.result()
-        consumer_group_accumulation = consumer_group_accumulation_future.result()
-
-    # %% Accumulate the forecasted data into municipals and consumer groups
-    response = {
-        "partials": single_forecast_responses,
-        "accumulations": {
-            "municipal": municipal_accumulation,
-            "consumerGroup": consumer_group_accumulation,
-        },
+        municipals = municipals_future.result()
+        consumer_groups = consumer_groups_future.result()
+    municipal_keys = list(municipals)
+    usage_type_ids = {
+        identifier: usage_type_id for usage_type_id, (identifier, _) in consumer_groups.items()
     }
-    _executor_logger.info("Finished request handling. Returning response")
-    return ujson.dumps(response, ensure_ascii=False, sort_keys=False).encode("utf-8")
+    series_counts = _count_requested_series(municipal_keys, queries)
+    area_names = _get_area_names(
+        municipal_keys,
+        municipals,
+        {level for query in queries for level in query.accumulation_levels},
+    )
+    accumulations = [
+        functions.Accumulation(municipals, consumer_groups, query.accumulation_levels)
+        for query in queries
+    ]
+    single_forecast_responses = [[] for _ in queries]
+    with concurrent.futures.ThreadPoolExecutor() as tpe:
+        _executor_logger.info("Running forecasts in threads")
+        for query_series, calculated_series in _calculate_shards(
+            municipal_keys, queries, series_counts, usage_type_ids, tpe
+        ):
+            accumulation_futures = []
+            for query, series_count, selected_series, accumulation, partials in zip(
+                queries, series_counts, query_series, accumulations, single_forecast_responses
+            ):
+                calculated = calculated_series[_calculation_key(query, series_count)]
+                forecast_results = [
+                    calculated[(s.municipal, s.consumer_group)] for s in selected_series
+                ]
+                accumulation_futures.append(tpe.submit(accumulation.add, forecast_results))
+                if query.include_partials:
+                    partials.extend(
+                        functions.build_response(
+                            query, municipals, consumer_groups, forecast_result
+                        )
+                        for forecast_result in forecast_results
+                    )
+            for accumulation_future in accumulation_futures:
+                accumulation_future.result()
+        _executor_logger.info("Finished forecast calculation and partial response building")
+    return [
+        {"partials": partials, "accumulations": accumulation.result(area_names)}
+        for partials, accumulation in zip(single_forecast_responses, accumulations)
+    ]
@@ -2,6 +2,7 @@
 import asyncio
 import logging
 import os
+import pathlib
 import signal
 import sys
 import threading
@@ -12,6 +13,10 @@ import amqp_rpc_server
 import pika.exchange_type
 import pydantic.error_wrappers
 
+import capture
+import database
+import database.maintenance
+import database.snapshot
 import server_functions
 import settings
 import tools
@@ -27,6 +32,30 @@ def signal_handler(sign, frame):
     _stop_event.set()
 
 
+def synchronize_snapshot(directory: pathlib.Path, interval: int):
+    """Synchronize the local usage data snapshot periodically until the service is stopped"""
+    while not _stop_event.wait(interval):
+        try:
+            database.snapshot.synchronize(directory)
+        except Exception as sync_error:
+            logging.error("Unable to synchronize the usage data snapshot", exc_info=sync_error)
+
+
+def refresh_yearly_usages(interval: int):
+    """Refresh the yearly rollup of the usage data periodically until the service is stopped"""
+    while not _stop_event.wait(interval):
+        try:
+            database.maintenance.refresh_yearly_usages()
+        except Exception as refresh_error:
+            logging.error("Unable to refresh the yearly usage rollup", exc_info=refresh_error)
+
+
+def report_pool_statistics(interval: int):
+    """Log the statistics of the connection pool periodically until the service is stopped"""
+    while not _stop_event.wait(interval):
+        logging.info("Connection pool statistics: %s", database.pool_statistics())
+
+
 if __name__ == "__main__":
     # Read the service settings and configure the logging
     _service_settings = settings.ServiceSettings()
@@ -90,12 +119,53 @@ if __name__ == "__main__":
         )
         sys.exit(1)
     logging.info("Passed all pre-startup checks and all dependent services are reachable")
+    threading.Thread(
+        target=report_pool_statistics,
+        args=(_db_settings.pool_statistics_interval,),
+        daemon=True,
+    ).start()
+    # = Create the indexes and the yearly rollup and refresh the rollup if it is used =
+    if _db_settings.manage_schema:
+        logging.info("Checking the indexes and tables used by the service")
+        database.maintenance.ensure_performance_objects()
+    if _db_settings.use_yearly_rollup:
+        if not database.maintenance.rollup_tables_exist():
+            logging.critical(
+                "The yearly usage rollup does not exist. Set CONFIG_DB_MANAGE_SCHEMA or run "
+                "`python -m database.maintenance` to create it"
+            )
+            sys.exit(1)
+        logging.info("Refreshing the yearly usage rollup")
+        database.maintenance.refresh_yearly_usages()
+        threading.Thread(
+            target=refresh_yearly_usages,
+            args=(_db_settings.rollup_refresh_interval,),
+            daemon=True,
+        ).start()
+    # = Synchronize the local usage data snapshot if one is configured =
+    _snapshot_settings = settings.SnapshotSettings()
+    if _snapshot_settings.directory is not None and _snapshot_settings.sync_enabled:
+        logging.info("Synchronizing the usage data snapshot in %s", _snapshot_settings.directory)
+        database.snapshot.synchronize(_snapshot_settings.directory)
+        threading.Thread(
+            target=synchronize_snapshot,
+            args=(_snapshot_settings.directory, _snapshot_settings.sync_interval),
+            daemon=True,
+        ).start()
+    # = Capture the incoming messages if a capture file is configured =
+    _content_validator, _executor = server_functions.content_validator, server_functions.executor
+    _capture_settings = settings.CaptureSettings()
+    if _capture_settings.file is not None:
+        logging.info("Capturing the incoming messages into %s", _capture_settings.file)
+        _content_validator, _executor = capture.Recorder(
+            _capture_settings.file, _capture_settings.max_bytes, _capture_settings.backup_count
+        ).wrap(_content_validator, _executor)
     logging.info("Starting the AMQP Server")
     amqp_server = amqp_rpc_server.Server(
         amqp_dsn=_amqp_settings.dsn,
         exchange_name=_amqp_settings.bind_exchange,
-        content_validator=server_functions.content_validator,
-        executor=server_functions.executor,
+        content_validator=_content_validator,
+        executor=_executor,
         max_reconnection_attempts=3,
         exchange_type=pika.exchange_type.ExchangeType.direct,
         queue_name="forecast-requests",
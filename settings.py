@@ -1,3 +1,6 @@
+import pathlib
+import typing
+
 import pydantic
 
 
@@ -24,6 +27,73 @@ class ServiceSettings(pydantic.BaseSettings):
     The logging level which will be visible on the stdout
     """
 
+    bootstrap_budget: int = pydantic.Field(
+        default=10_000_000, alias="CONFIG_BOOTSTRAP_BUDGET", env="CONFIG_BOOTSTRAP_BUDGET", gt=0
+    )
+    """
+    Bootstrap Budget
+
+    The max. number of bootstrapped values calculated for the prediction intervals of a single
+    query. The number of resamples is reduced, down to 100 resamples, if the series requested by
+    the query would exceed the budget. The reduction only depends on the number and the lengths of
+    the requested series, so identical requests get identical bands
+    """
+
+    compression_threshold: int = pydantic.Field(
+        default=65536,
+        alias="CONFIG_COMPRESSION_THRESHOLD",
+        env="CONFIG_COMPRESSION_THRESHOLD",
+        ge=0,
+    )
+    """
+    Compression Threshold
+
+    The size in bytes from which on replies are compressed, if the client requested a content
+    encoding
+    """
+
+    shard_size: int = pydantic.Field(
+        default=5000, alias="CONFIG_SHARD_SIZE", env="CONFIG_SHARD_SIZE", gt=0
+    )
+    """
+    Shard Size
+
+    The max. number of series which are pulled and calculated as one unit. Larger requests are
+    split into shards of whole districts
+    """
+
+    shard_workers: int = pydantic.Field(
+        default=4, alias="CONFIG_SHARD_WORKERS", env="CONFIG_SHARD_WORKERS", gt=0
+    )
+    """
+    Shard Workers
+
+    The max. number of shards of a request which are pulled and calculated in parallel. Further
+    shards are only started once the results of a previous shard have been consumed
+    """
+
+    pipelined_execution: bool = pydantic.Field(
+        default=False, alias="CONFIG_PIPELINED_EXECUTION", env="CONFIG_PIPELINED_EXECUTION"
+    )
+    """
+    Pipelined Execution
+
+    Whether requests are pulled and calculated in chunks of districts, with the usage data of the
+    next chunk being pulled while the current chunk is calculated
+    """
+
+    pipeline_chunk_size: int = pydantic.Field(
+        default=500,
+        alias="CONFIG_PIPELINE_CHUNK_SIZE",
+        env="CONFIG_PIPELINE_CHUNK_SIZE",
+        gt=0,
+    )
+    """
+    Pipeline Chunk Size
+
+    The max. number of series pulled as one chunk in the pipelined execution
+    """
+
     class Config:
         env_file = ".env"
 
@@ -67,5 +137,190 @@ class DatabaseSettings(pydantic.BaseSettings):
     The data source name (expressed as URI) pointing to the installation of the used postgresql database
     """
 
+    pool_size: int = pydantic.Field(
+        default=10, alias="CONFIG_DB_POOL_SIZE", env="CONFIG_DB_POOL_SIZE", ge=1
+    )
+    """
+    Connection Pool Size
+
+    The number of connections which are kept open in the connection pool. This should match the
+    number of threads which query the database at the same time
+    """
+
+    pool_max_overflow: int = pydantic.Field(
+        default=10, alias="CONFIG_DB_POOL_MAX_OVERFLOW", env="CONFIG_DB_POOL_MAX_OVERFLOW", ge=0
+    )
+    """
+    Connection Pool Overflow
+
+    The number of connections which may be opened in addition to the pooled connections if all
+    pooled connections are checked out. These connections are closed once they are returned
+    """
+
+    pool_timeout: float = pydantic.Field(
+        default=30, alias="CONFIG_DB_POOL_TIMEOUT", env="CONFIG_DB_POOL_TIMEOUT", gt=0
+    )
+    """
+    Connection Pool Timeout
+
+    The number of seconds a thread waits for a connection before giving up
+    """
+
+    pool_recycle: int = pydantic.Field(
+        default=90, alias="CONFIG_DB_POOL_RECYCLE", env="CONFIG_DB_POOL_RECYCLE"
+    )
+    """
+    Connection Recycling Interval
+
+    The number of seconds after which a pooled connection is replaced by a new connection. A
+    negative value disables the recycling of connections
+    """
+
+    pool_pre_ping: bool = pydantic.Field(
+        default=True, alias="CONFIG_DB_POOL_PRE_PING", env="CONFIG_DB_POOL_PRE_PING"
+    )
+    """
+    Connection Liveness Check
+
+    Whether a pooled connection is tested for liveness before it is handed out, so connections
+    closed by the database server are replaced transparently
+    """
+
+    pool_statistics_interval: int = pydantic.Field(
+        default=300,
+        alias="CONFIG_DB_POOL_STATISTICS_INTERVAL",
+        env="CONFIG_DB_POOL_STATISTICS_INTERVAL",
+        gt=0,
+    )
+    """
+    Connection Pool Statistics Interval
+
+    The number of seconds between two log messages reporting the checkouts, timeouts and wait
+    times of the connection pool
+    """
+
+    query_cache_size: int = pydantic.Field(
+        default=500, alias="CONFIG_DB_QUERY_CACHE_SIZE", env="CONFIG_DB_QUERY_CACHE_SIZE", ge=0
+    )
+    """
+    Compiled Query Cache Size
+
+    The number of compiled SQL statements which are cached by the database engine, so the fixed
+    queries of the service are only compiled once
+    """
+
+    manage_schema: bool = pydantic.Field(
+        default=False, alias="CONFIG_DB_MANAGE_SCHEMA", env="CONFIG_DB_MANAGE_SCHEMA"
+    )
+    """
+    Schema Management
+
+    Whether the indexes and the yearly rollup table used by this service are checked and created
+    during the startup of the service
+    """
+
+    use_yearly_rollup: bool = pydantic.Field(
+        default=False, alias="CONFIG_DB_USE_YEARLY_ROLLUP", env="CONFIG_DB_USE_YEARLY_ROLLUP"
+    )
+    """
+    Yearly Rollup Usage
+
+    Whether the usage data is read from the yearly rollup table instead of the usages table. The
+    rollup table is refreshed incrementally by the service with the usages recorded since the last
+    refresh. Usages without a recording time and usages committed with a recording time before
+    the last refresh are only included by running ``python -m database.maintenance --rebuild``,
+    which sets the missing recording times to the time of the rebuild. The service does not start
+    if the rollup table does not exist and the schema is not managed by the service
+    """
+
+    rollup_refresh_interval: int = pydantic.Field(
+        default=300,
+        alias="CONFIG_DB_ROLLUP_REFRESH_INTERVAL",
+        env="CONFIG_DB_ROLLUP_REFRESH_INTERVAL",
+        gt=0,
+    )
+    """
+    Yearly Rollup Refresh Interval
+
+    The number of seconds between two incremental refreshes of the yearly rollup table
+    """
+
+    class Config:
+        env_file = ".env"
+
+
+class SnapshotSettings(pydantic.BaseSettings):
+    """Settings which are related to the local snapshot of the usage data"""
+
+    directory: typing.Optional[pathlib.Path] = pydantic.Field(
+        default=None, alias="CONFIG_SNAPSHOT_DIRECTORY", env="CONFIG_SNAPSHOT_DIRECTORY"
+    )
+    """
+    Snapshot Directory
+
+    The directory in which the memory-mapped snapshot of the yearly usage sums is stored. If no
+    directory is set, the usage data is read from the database for every request
+    """
+
+    sync_enabled: bool = pydantic.Field(
+        default=True, alias="CONFIG_SNAPSHOT_SYNC", env="CONFIG_SNAPSHOT_SYNC"
+    )
+    """
+    Snapshot Synchronization
+
+    Whether this instance synchronizes the snapshot with the database. Replicas which share the
+    snapshot directory with a synchronizing instance may disable this
+    """
+
+    sync_interval: int = pydantic.Field(
+        default=300,
+        alias="CONFIG_SNAPSHOT_SYNC_INTERVAL",
+        env="CONFIG_SNAPSHOT_SYNC_INTERVAL",
+        gt=0,
+    )
+    """
+    Snapshot Synchronization Interval
+
+    The number of seconds between two incremental synchronizations of the snapshot
+    """
+
+    class Config:
+        env_file = ".env"
+
+
+class CaptureSettings(pydantic.BaseSettings):
+    """Settings which are related to the capture of the incoming requests"""
+
+    file: typing.Optional[pathlib.Path] = pydantic.Field(
+        default=None, alias="CONFIG_CAPTURE_FILE", env="CONFIG_CAPTURE_FILE"
+    )
+    """
+    Capture File
+
+    The file into which the incoming messages and the timings of their handling are written. If
+    no file is set, the incoming messages are not captured
+    """
+
+    max_bytes: int = pydantic.Field(
+        default=64 * 1024 * 1024,
+        alias="CONFIG_CAPTURE_MAX_BYTES",
+        env="CONFIG_CAPTURE_MAX_BYTES",
+        gt=0,
+    )
+    """
+    Capture File Size
+
+    The size in bytes at which the capture file is rotated
+    """
+
+    backup_count: int = pydantic.Field(
+        default=5, alias="CONFIG_CAPTURE_BACKUP_COUNT", env="CONFIG_CAPTURE_BACKUP_COUNT", ge=1
+    )
+    """
+    Capture File Backups
+
+    The number of rotated capture files which are kept next to the capture file
+    """
+
     class Config:
         env_file = ".env"
@@ -0,0 +1,79 @@
+"""Check the capture of the incoming messages and their replay"""
+import gzip
+
+import pytest
+import ujson
+
+import capture
+import replay
+import server_functions
+
+
+def _content_validator(message: bytes) -> bool:
+    return b"keys" in message
+
+
+def _executor(message: bytes) -> bytes:
+    query = ujson.loads(message)
+    if query["keys"] == ["fail"]:
+        raise ValueError("unable to answer the query")
+    partials = [{"municipal": key, "usage": len(key) / 3} for key in query["keys"]]
+    return ujson.dumps({"partials": partials}).encode("utf-8")
+
+
+def test_recorder_captures_every_message(tmp_path):
+    capture_file = tmp_path / "capture" / "messages.jsonl"
+    # the small file size makes the recorder rotate the capture file
+    content_validator, executor = capture.Recorder(capture_file, 200, 10).wrap(
+        _content_validator, _executor
+    )
+    for message in (b'{"keys": ["03"]}', b"{}", b'{"keys": ["fail"]}', b'{"keys": ["05"]}'):
+        if content_validator(message):
+            try:
+                executor(message)
+            except ValueError:
+                pass
+    records = capture.read(capture_file)
+    assert len(list(capture_file.parent.iterdir())) > 1
+    assert [(record["body"], record["valid"], record["error"]) for record in records] == [
+        ('{"keys": ["03"]}', True, None),
+        ("{}", False, None),
+        ('{"keys": ["fail"]}', True, "ValueError"),
+        ('{"keys": ["05"]}', True, None),
+    ]
+    assert records[0]["replySize"] == len(_executor(b'{"keys": ["03"]}'))
+    assert records[1]["executionTime"] is None
+    assert all(record["validationTime"] is not None for record in records)
+
+
+def test_digests_ignore_compression_and_order_of_partials():
+    reply = {"partials": [{"municipal": "03", "usage": 1 / 3}, {"municipal": "05", "usage": 2.0}]}
+    reordered_reply = {"partials": list(reversed(reply["partials"]))}
+    digest = replay.digest_reply(ujson.dumps(reply).encode("utf-8"), 10)
+    assert replay.digest_reply(gzip.compress(ujson.dumps(reply).encode("utf-8")), 10) == digest
+    assert replay.digest_reply(ujson.dumps(reordered_reply).encode("utf-8"), 10) == digest
+    changed_reply = {"partials": [{"municipal": "03", "usage": 0.3}, reply["partials"][1]]}
+    assert replay.digest_reply(ujson.dumps(changed_reply).encode("utf-8"), 10) != digest
+
+
+@pytest.mark.parametrize("consumers", [1, 3])
+def test_replay_reports_the_digest_of_every_message(monkeypatch, consumers):
+    monkeypatch.setattr(server_functions, "content_validator", _content_validator)
+    monkeypatch.setattr(server_functions, "executor", _executor)
+    bodies = ['{"keys": ["03"]}', "{}", '{"keys": ["fail"]}', '{"keys": ["03", "05"]}']
+    records = [
+        {
+            "timestamp": 1000.0 + index,
+            "body": body,
+            "valid": body != "{}",
+            "validationTime": 0.001,
+            "executionTime": 0.01,
+        }
+        for index, body in enumerate(bodies)
+    ]
+    digests, report = replay.replay(records, None, consumers, 10)
+    assert [digest["status"] for digest in digests] == ["ok", "rejected", "error", "ok"]
+    assert digests[0]["digest"] == replay.digest_reply(_executor(bodies[0].encode("utf-8")), 10)
+    assert digests[1]["digest"] is None
+    assert report["messages"] == len(bodies)
+    assert report["labels"]["valid"]["messages"] == 3
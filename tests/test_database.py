@@ -0,0 +1,130 @@
+"""Check the lookups of the municipals and the local snapshot of the usage data"""
+import datetime
+import uuid
+
+import pytest
+
+import database
+import database.snapshot
+import server_functions
+
+_USAGE_TYPE = uuid.UUID(int=1)
+
+
+def test_escape_like():
+    assert server_functions._escape_like("03") == "03"
+    assert server_functions._escape_like("0_4%\\") == "0\\_4\\%\\\\"
+
+
+@pytest.fixture
+def shapes(sqlite_database):
+    with sqlite_database.begin() as connection:
+        for name, key, nuts_key in [
+            ("State", "03", "DE9"),
+            ("District", "03451", "DE945"),
+            ("Municipal 1", "034510000001", "DE945"),
+            ("Municipal 2", "034510000002", "DE945"),
+            ("Municipal 3", "034520000001", None),
+            ("Municipal 4", "051110000000", "DEA11"),
+        ]:
+            connection.exec_driver_sql(
+                "INSERT INTO geodata.shapes (name, key, nuts_key) VALUES (?, ?, ?)",
+                (name, key, nuts_key),
+            )
+
+
+@pytest.mark.usefixtures("shapes")
+def test_resolve_municipals_matches_prefixes_and_municipal_keys():
+    assert server_functions._resolve_municipals(["03451", "034520000001"]) == {
+        "034510000001": ("Municipal 1", "034510000001", "DE945"),
+        "034510000002": ("Municipal 2", "034510000002", "DE945"),
+        "034520000001": ("Municipal 3", "034520000001", None),
+    }
+    assert list(server_functions._resolve_municipals(["03"])) == [
+        "034510000001",
+        "034510000002",
+        "034520000001",
+    ]
+    assert server_functions._resolve_municipals(["0345"]).keys() == {
+        "034510000001",
+        "034510000002",
+        "034520000001",
+    }
+
+
+def test_resolve_municipals_escapes_wildcards(monkeypatch):
+    executed_queries = []
+
+    class RecordingEngine:
+        def execute(self, query):
+            executed_queries.append(query)
+            return type("Result", (), {"all": lambda self: []})()
+
+    monkeypatch.setattr(database, "engine", RecordingEngine())
+    server_functions._resolve_municipals(["03_5%"])
+    assert "03\\_5\\%%" in executed_queries[0].compile().params.values()
+
+
+def _insert_usages(engine, rows: list[tuple]) -> None:
+    with engine.begin() as connection:
+        for municipal, year, amount, recorded_at in rows:
+            connection.exec_driver_sql(
+                "INSERT INTO water_usage.usages (municipality, date, usage_type, recorded_at, "
+                "amount) VALUES (?, ?, ?, ?, ?)",
+                (municipal, datetime.datetime(year, 1, 1), str(_USAGE_TYPE), recorded_at, amount),
+            )
+
+
+def _read_snapshot(directory) -> dict:
+    snapshot = database.snapshot.load(directory)
+    return {
+        s.municipal: (s.start_year, s.reference.tolist())
+        for s in snapshot.read_series(["034510000001", "034510000002"], [_USAGE_TYPE])
+    }
+
+
+def test_snapshot_round_trip(sqlite_database, tmp_path):
+    directory = tmp_path / "snapshot"
+    recorded_at = datetime.datetime(2020, 1, 1)
+    _insert_usages(
+        sqlite_database,
+        [
+            ("034510000001", 2010, 10.0, recorded_at),
+            ("034510000001", 2010, 5.0, recorded_at),
+            ("034510000001", 2011, 20.0, recorded_at),
+            ("034510000002", 2011, 7.0, recorded_at),
+        ],
+    )
+    assert database.snapshot.load(directory) is None
+    database.snapshot.synchronize(directory)
+    assert _read_snapshot(directory) == {
+        "034510000001": (2010, [15.0, 20.0]),
+        "034510000002": (2011, [7.0]),
+    }
+    # %% Only the usages recorded after the watermark are added by a synchronization
+    _insert_usages(
+        sqlite_database,
+        [
+            ("034510000001", 2011, 1.0, datetime.datetime(2021, 1, 1)),
+            ("034510000002", 2012, 3.0, None),
+        ],
+    )
+    database.snapshot.synchronize(directory)
+    assert database.snapshot.load(directory).watermark == datetime.datetime(2021, 1, 1)
+    assert _read_snapshot(directory) == {
+        "034510000001": (2010, [15.0, 21.0]),
+        "034510000002": (2011, [7.0]),
+    }
+    # %% A rebuild backfills the usages without a recording time
+    database.snapshot.synchronize(directory, rebuild=True)
+    assert _read_snapshot(directory) == {
+        "034510000001": (2010, [15.0, 21.0]),
+        "034510000002": (2011, [7.0, 3.0]),
+    }
+    with sqlite_database.connect() as connection:
+        assert (
+            connection.exec_driver_sql(
+                "SELECT count(*) FROM water_usage.usages WHERE recorded_at IS NULL"
+            ).scalar()
+            == 0
+        )
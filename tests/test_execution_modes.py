@@ -0,0 +1,167 @@
+"""Check that the execution modes of the executor return identical responses"""
+import datetime
+import math
+import random
+import uuid
+
+import pytest
+
+import models
+import series
+import server_functions
+import tools
+
+_CONSUMER_GROUPS = {
+    uuid.UUID(int=1): ("households", "Households"),
+    uuid.UUID(int=2): ("businesses", "Businesses"),
+}
+_MUNICIPALS = {
+    f"{district}0000{index:03d}": (
+        f"Municipal {district}0000{index:03d}",
+        f"{district}0000{index:03d}",
+        f"DE94{district[-1]}",
+    )
+    for district in ("03451", "03452", "03453")
+    for index in range(4)
+}
+
+
+def _usage_rows() -> list[tuple]:
+    """Create the yearly usages of every municipal and consumer group"""
+    rng = random.Random(0)
+    rows = []
+    for municipal in sorted(_MUNICIPALS):
+        for consumer_group in sorted(_CONSUMER_GROUPS):
+            start = rng.randint(2000, 2004)
+            for year in range(start, 2016):
+                rows.append(
+                    (municipal, consumer_group, datetime.date(year, 1, 1), rng.uniform(100, 1000))
+                )
+    return rows
+
+
+_USAGE_ROWS = _usage_rows()
+
+
+@pytest.fixture(autouse=True)
+def database_lookups(monkeypatch):
+    """Replace the database lookups of the executor with the usages created above"""
+
+    def resolve_municipals(keys):
+        return {
+            key: municipal for key, municipal in _MUNICIPALS.items() if key.startswith(tuple(keys))
+        }
+
+    def fetch_usage_series(municipal_keys, usage_type_ids):
+        return series.from_usage_rows(
+            [row for row in _USAGE_ROWS if row[0] in municipal_keys and row[1] in usage_type_ids]
+        )
+
+    monkeypatch.setattr(server_functions, "_resolve_municipals", resolve_municipals)
+    monkeypatch.setattr(server_functions, "_fetch_usage_series", fetch_usage_series)
+    monkeypatch.setattr(
+        tools,
+        "get_consumer_groups_by_identifiers",
+        lambda identifiers: {
+            usage_type_id: consumer_group
+            for usage_type_id, consumer_group in _CONSUMER_GROUPS.items()
+            if consumer_group[0] in identifiers
+        },
+    )
+    monkeypatch.setattr(tools, "get_area_names", lambda keys: {k: f"Area {k}" for k in keys})
+
+
+def _queries() -> list[models.ForecastParameters]:
+    return [
+        models.ForecastParameters.parse_obj(
+            {
+                "model": model,
+                "keys": ["03"],
+                "consumerGroups": ["households", "businesses"],
+                "forecastSize": 5,
+                "accumulationLevels": ["districts", "nuts3"],
+                "intervalQuantiles": [0.1, 0.5, 0.9],
+                "intervalResamples": 200,
+            }
+        )
+        for model in ("linear", "auto")
+    ]
+
+
+def _answer(monkeypatch, **service_settings) -> list[dict]:
+    for name, value in service_settings.items():
+        monkeypatch.setattr(server_functions._service_settings, name, value)
+    return server_functions._answer_queries(_queries())
+
+
+def _assert_close(actual, expected, path="$"):
+    """Compare the responses, allowing for the rounding of sums added up in another order"""
+    if isinstance(expected, float):
+        assert math.isclose(actual, expected, rel_tol=1e-9, abs_tol=1e-9), path
+    elif isinstance(expected, dict):
+        assert actual.keys() == expected.keys(), path
+        for key in expected:
+            _assert_close(actual[key], expected[key], f"{path}.{key}")
+    elif isinstance(expected, list):
+        assert len(actual) == len(expected), path
+        for index, (actual_item, expected_item) in enumerate(zip(actual, expected)):
+            _assert_close(actual_item, expected_item, f"{path}[{index}]")
+    else:
+        assert actual == expected, path
+
+
+def _sort_partials(responses: list[dict]) -> list[dict]:
+    for response in responses:
+        response["partials"].sort(
+            key=lambda partial: (partial["municipal"]["key"], partial["consumerGroup"]["key"])
+        )
+    return responses
+
+
+@pytest.mark.parametrize(
+    "service_settings",
+    [
+        pytest.param({"shard_size": 4, "shard_workers": 3}, id="sharded"),
+        pytest.param({"shard_size": 4, "bootstrap_budget": 5000}, id="sharded-small-budget"),
+        pytest.param({"pipelined_execution": True, "pipeline_chunk_size": 6}, id="pipelined"),
+    ],
+)
+def test_execution_modes_return_identical_responses(monkeypatch, service_settings):
+    plain = _sort_partials(
+        _answer(
+            monkeypatch,
+            shard_size=10_000,
+            pipelined_execution=False,
+            bootstrap_budget=service_settings.get(
+                "bootstrap_budget", server_functions._service_settings.bootstrap_budget
+            ),
+        )
+    )
+    with monkeypatch.context() as mode_monkeypatch:
+        split = _sort_partials(_answer(mode_monkeypatch, **service_settings))
+    assert [response["partials"] for response in split] == [
+        response["partials"] for response in plain
+    ]
+    _assert_close(
+        [response["accumulations"] for response in split],
+        [response["accumulations"] for response in plain],
+    )
+
+
+def test_sharded_execution_bounds_the_shards_in_flight(monkeypatch):
+    monkeypatch.setattr(server_functions._service_settings, "shard_size", 2)
+    monkeypatch.setattr(server_functions._service_settings, "shard_workers", 2)
+    monkeypatch.setattr(server_functions._service_settings, "pipelined_execution", False)
+    started_shards = []
+    monkeypatch.setattr(
+        server_functions,
+        "_calculate_shard",
+        lambda municipal_keys, *_: started_shards.append(municipal_keys) or municipal_keys,
+    )
+    municipal_keys = sorted(_MUNICIPALS)
+    consumed_shards = []
+    for shard in server_functions._calculate_shards(municipal_keys, [], [], {}, None):
+        assert len(started_shards) - len(consumed_shards) <= 2
+        consumed_shards.append(shard)
+    assert consumed_shards == started_shards
+    assert sorted(key for shard in consumed_shards for key in shard) == municipal_keys
@@ -0,0 +1,201 @@
+"""Check the forecast calculations and the conversion of their results"""
+import uuid
+
+import numpy
+import pytest
+import ujson
+
+import enums
+import functions
+import models
+import series
+
+_CONSUMER_GROUP = uuid.UUID(int=1)
+_MUNICIPALS = {"034510000001": ("Municipal", "034510000001", "DE945")}
+_CONSUMER_GROUPS = {_CONSUMER_GROUP: ("households", "Households")}
+
+
+def _calculated_series(model: enums.ForecastModel, forecast_size: int = 3) -> series.UsageSeries:
+    usage_series = series.UsageSeries(
+        "034510000001",
+        _CONSUMER_GROUP,
+        2010,
+        2015,
+        numpy.array([500.0, 520.0, 515.0, 540.0, 560.0, 555.0]),
+    )
+    return functions.run_forecast(usage_series, model, forecast_size)
+
+
+@pytest.mark.parametrize(
+    "parameters",
+    [
+        {"model": "auto", "intervalQuantiles": [0.1, 0.9], "intervalResamples": 50},
+        {"model": "linear", "includeReference": False},
+        {"model": "polynomial", "responseMode": "coefficients"},
+    ],
+)
+def test_build_response_matches_models(parameters):
+    request = models.ForecastParameters.parse_obj({"keys": ["03"], "forecastSize": 3, **parameters})
+    usage_series = _calculated_series(request.model, request.forecast_size)
+    if request.interval_quantiles is not None:
+        functions.calculate_prediction_intervals(
+            [usage_series], request.interval_quantiles, request.interval_resamples, 1, 10**6
+        )
+    response = functions.build_response(request, _MUNICIPALS, _CONSUMER_GROUPS, usage_series)
+    # keys unknown to the models are dropped while parsing and missing keys fail the parsing
+    parsed_response = ujson.loads(
+        models.ForecastResult.parse_obj(response).json(by_alias=True, exclude_unset=True)
+    )
+    assert _key_paths(response) == _key_paths(parsed_response)
+    assert parsed_response["forecast"]["float"] == usage_series.score
+
+
+def _key_paths(value, path="") -> set:
+    """Get the paths of all keys of the nested dictionaries"""
+    if not isinstance(value, dict):
+        return set()
+    keys = set()
+    for key, item in value.items():
+        keys.add(f"{path}.{key}")
+        keys |= _key_paths(item, f"{path}.{key}")
+    return keys
+
+
+@pytest.mark.parametrize(
+    "requested_resamples, series_count, budget, expected_resamples",
+    [(500, 1, 10**6, 500), (5000, 10, 90_000, 1000), (5000, 100, 90_000, 100), (50, 100, 90, 50)],
+)
+def test_prediction_intervals_resamples_stay_within_budget(
+    requested_resamples, series_count, budget, expected_resamples
+):
+    # the series has six reference values and three forecasted values
+    usage_series = _calculated_series(enums.ForecastModel.LINEAR)
+    functions.calculate_prediction_intervals(
+        [usage_series], [0.1, 0.9], requested_resamples, series_count, budget
+    )
+    assert usage_series.resamples == expected_resamples
+    assert usage_series.bands[0.1].shape == (3,)
+
+
+def _series(municipal: str, consumer_group, start_year: int, reference: list, forecast: list):
+    usage_series = series.UsageSeries(
+        municipal,
+        consumer_group,
+        start_year,
+        start_year + len(reference) - 1,
+        numpy.array(reference, dtype=numpy.float64),
+    )
+    usage_series.forecast = numpy.array(forecast, dtype=numpy.float64)
+    return usage_series
+
+
+def test_accumulation_sums_the_series_by_area_and_consumer_group():
+    businesses = uuid.UUID(int=2)
+    municipals = {
+        "034510000001": ("Municipal 1", "034510000001", "DE945"),
+        "034510000002": ("Municipal 2", "034510000002", "DE945"),
+        "034520000001": ("Municipal 3", "034520000001", None),
+    }
+    consumer_groups = {**_CONSUMER_GROUPS, businesses: ("businesses", "Businesses")}
+    accumulation = functions.Accumulation(
+        municipals,
+        consumer_groups,
+        [enums.ForecastGranularity.DISTRICT, enums.ForecastGranularity.NUTS_3],
+    )
+    # the series are added in two chunks, as the shards of a request are
+    accumulation.add(
+        [
+            _series("034510000001", _CONSUMER_GROUP, 2010, [1, 2, 3], [4, 5]),
+            _series("034510000001", businesses, 2011, [10, 20], [30, 40]),
+        ]
+    )
+    accumulation.add(
+        [
+            _series("034510000002", _CONSUMER_GROUP, 2009, [100, 200, 300], [400]),
+            _series("034520000001", businesses, 2012, [1000], [2000, 3000, 4000]),
+        ]
+    )
+    result = accumulation.result({"03451": "District 1", "03452": "District 2", "DE945": "NUTS"})
+
+    def sums(entries: dict) -> dict:
+        return {key: (entry["startYear"], entry["usages"]) for key, entry in entries.items()}
+
+    assert sums(result["municipal"]["reference"]) == {
+        "034510000001": (2010, [1, 12, 23]),
+        "034510000002": (2009, [100, 200, 300]),
+        "034520000001": (2012, [1000]),
+    }
+    assert sums(result["municipal"]["forecast"]) == {
+        "034510000001": (2013, [34, 45]),
+        "034510000002": (2012, [400]),
+        "034520000001": (2013, [2000, 3000, 4000]),
+    }
+    assert sums(result["consumerGroup"]["reference"]) == {
+        "households": (2009, [100, 201, 302, 3]),
+        "businesses": (2011, [10, 1020]),
+    }
+    assert sums(result["consumerGroup"]["forecast"]) == {
+        "households": (2012, [400, 4, 5]),
+        "businesses": (2013, [2030, 3040, 4000]),
+    }
+    districts = result["levels"]["districts"]
+    assert sums(districts["reference"]) == {
+        "03451": (2009, [100, 201, 312, 23]),
+        "03452": (2012, [1000]),
+    }
+    assert sums(districts["forecast"]) == {
+        "03451": (2012, [400, 34, 45]),
+        "03452": (2013, [2000, 3000, 4000]),
+    }
+    assert districts["reference"]["03451"]["displayName"] == "District 1"
+    # the municipal without a NUTS key is not part of any NUTS area
+    assert sums(result["levels"]["nuts3"]["reference"]) == {"DE945": (2009, [100, 201, 312, 23])}
+    assert result["municipal"]["reference"]["034510000001"]["nutsKey"] == "DE945"
+
+
+def _forecast_auto(reference: list) -> series.UsageSeries:
+    usage_series = series.UsageSeries(
+        "034510000001",
+        _CONSUMER_GROUP,
+        2010,
+        2010 + len(reference) - 1,
+        numpy.array(reference, dtype=numpy.float64),
+    )
+    return functions.run_forecast(usage_series, enums.ForecastModel.AUTO, 3)
+
+
+def test_auto_model_falls_back_to_linear_for_short_series():
+    two_usages = _forecast_auto([1000, 1105])
+    assert two_usages.model is enums.ForecastModel.LINEAR
+    assert two_usages.scores == {}
+    assert two_usages.forecast.tolist() == pytest.approx([1210, 1315, 1420])
+    three_usages = _forecast_auto([1000, 1105, 1050])
+    assert enums.ForecastModel.POLYNOMIAL not in three_usages.scores
+    assert three_usages.model is not enums.ForecastModel.POLYNOMIAL
+
+
+def test_auto_model_ranks_by_adjusted_score():
+    rng = numpy.random.default_rng(0)
+    linear_usages = 1000 + 50 * numpy.arange(12) + rng.normal(0, 40, 12)
+    assert _forecast_auto(linear_usages.tolist()).model is not enums.ForecastModel.POLYNOMIAL
+    quadratic_usages = 1000 + 5 * (numpy.arange(12) - 6) ** 2 * 10 + rng.normal(0, 5, 12)
+    quadratic_series = _forecast_auto(quadratic_usages.tolist())
+    assert quadratic_series.model is enums.ForecastModel.POLYNOMIAL
+    # the reported score is the plain R² score, the ranking uses the adjusted scores
+    assert quadratic_series.score > quadratic_series.scores[enums.ForecastModel.POLYNOMIAL]
+
+
+def test_prediction_intervals_do_not_depend_on_the_other_series():
+    usage_series = _calculated_series(enums.ForecastModel.LINEAR)
+    other_series = _calculated_series(enums.ForecastModel.LINEAR)
+    other_series.municipal = "034510000002"
+    lonely_series = _calculated_series(enums.ForecastModel.LINEAR)
+    functions.calculate_prediction_intervals(
+        [other_series, usage_series], [0.1, 0.5, 0.9], 200, 2, 10**6
+    )
+    functions.calculate_prediction_intervals([lonely_series], [0.1, 0.5, 0.9], 200, 2, 10**6)
+    for quantile in (0.1, 0.5, 0.9):
+        assert usage_series.bands[quantile].tolist() == lonely_series.bands[quantile].tolist()
+    assert numpy.all(usage_series.bands[0.1] <= usage_series.bands[0.5])
+    assert numpy.all(usage_series.bands[0.5] <= usage_series.bands[0.9])
+    assert usage_series.bands[0.1].tolist() != other_series.bands[0.1].tolist()
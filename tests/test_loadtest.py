@@ -0,0 +1,22 @@
+"""Check the in-process stand-in for the message broker"""
+import loadtest
+
+
+def test_broker_survives_failing_handlers():
+    def reply_handler(reply: bytes) -> str:
+        if reply == b"fail":
+            raise ValueError("unreadable reply")
+        return reply.decode("utf-8")
+
+    broker = loadtest.InProcessBroker(
+        lambda message: message != b"invalid",
+        lambda message: message,
+        consumers=1,
+        reply_handler=reply_handler,
+    )
+    broker.start()
+    for body in (b"fail", b"invalid", b"ok"):
+        broker.publish(body, "test")
+    broker.join()
+    assert [delivery.status for delivery in broker.deliveries] == ["error", "rejected", "ok"]
+    assert broker.deliveries[2].result == "ok"
@@ -0,0 +1,85 @@
+"""Check the validation of the forecast queries"""
+import pydantic
+import pytest
+
+import models
+
+_CONSUMER_GROUPS = ["households", "businesses", "industry"]
+
+
+@pytest.fixture
+def lookups(monkeypatch) -> dict:
+    """Replace the database lookups of the validators and record their arguments"""
+    calls = {"keys": [], "consumer_groups": []}
+
+    def check_keys(keys):
+        calls["keys"].append(keys)
+        unknown_keys = [key for key in keys if not key.startswith("03")]
+        if unknown_keys:
+            raise ValueError(f"The following keys have not been recognized: {unknown_keys}")
+
+    def check_consumer_groups(consumer_groups):
+        calls["consumer_groups"].append(consumer_groups)
+        if consumer_groups is None:
+            return list(_CONSUMER_GROUPS)
+        for consumer_group in consumer_groups:
+            if consumer_group not in _CONSUMER_GROUPS:
+                raise ValueError(f"The consumer group {consumer_group} was not found")
+        return consumer_groups
+
+    monkeypatch.setattr(models, "_check_keys", check_keys)
+    monkeypatch.setattr(models, "_check_consumer_groups", check_consumer_groups)
+    return calls
+
+
+def test_batch_query_checks_all_queries_at_once(lookups):
+    batch = models.BatchForecastQuery.parse_obj(
+        {
+            "queries": [
+                {"model": "linear", "keys": ["03451", "03452"], "consumerGroups": ["households"]},
+                {"model": "auto", "keys": ["03452", "03453"]},
+                {"model": "linear", "keys": ["03"], "consumerGroups": ["industry"]},
+            ]
+        }
+    )
+    assert lookups["keys"] == [["03451", "03452", "03453", "03"]]
+    assert lookups["consumer_groups"] == [None]
+    assert [query.consumer_groups for query in batch.queries] == [
+        ["households"],
+        _CONSUMER_GROUPS,
+        ["industry"],
+    ]
+
+
+def test_batch_query_checks_the_requested_consumer_groups_once(lookups):
+    models.BatchForecastQuery.parse_obj(
+        {
+            "queries": [
+                {"model": "linear", "keys": ["03"], "consumerGroups": ["households"]},
+                {"model": "linear", "keys": ["03"], "consumerGroups": ["households", "industry"]},
+            ]
+        }
+    )
+    assert lookups["consumer_groups"] == [["households", "industry"]]
+
+
+@pytest.mark.parametrize(
+    "queries",
+    [
+        [{"model": "linear", "keys": ["05"]}],
+        [
+            {"model": "linear", "keys": ["03"]},
+            {"model": "linear", "keys": ["03"], "consumerGroups": ["x"]},
+        ],
+        [],
+    ],
+)
+def test_batch_query_rejects_unknown_keys_and_consumer_groups(lookups, queries):
+    with pytest.raises(pydantic.ValidationError):
+        models.BatchForecastQuery.parse_obj({"queries": queries})
+
+
+def test_single_query_fills_in_all_consumer_groups(lookups):
+    query = models.ForecastQuery.parse_obj({"model": "linear", "keys": ["03"]})
+    assert query.consumer_groups == _CONSUMER_GROUPS
+    assert lookups["keys"] == [["03"]]
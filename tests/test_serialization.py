@@ -0,0 +1,78 @@
+"""Check the serialization and compression of the replies"""
+import gzip
+import random
+
+import pytest
+import ujson
+import zstandard
+
+import enums
+import serialization
+
+
+def _reply(partial_count: int) -> dict:
+    """Create a reply of a batch of queries with nested partials and accumulations"""
+    rng = random.Random(partial_count)
+
+    def usages(start: int, length: int) -> dict:
+        return {
+            "start": start,
+            "end": start + length - 1,
+            "amounts": [rng.uniform(0, 1000) for _ in range(length)],
+        }
+
+    partials = [
+        {
+            "forecast": {
+                "model": "linear",
+                "equation": "1.0 + 2.0·x",
+                "float": rng.random(),
+                "scores": None,
+                "usages": {**usages(2016, 20), "bands": {"0.1": [1.5, 2.5]}},
+                "curve": None,
+            },
+            "referenceUsages": usages(2000, 16),
+            "municipal": {"key": f"0345100{index:05d}", "name": "Münster", "nutsKey": None},
+            "consumerGroup": {"key": "households", "name": "Haushalte"},
+        }
+        for index in range(partial_count)
+    ]
+    accumulations = {
+        "municipal": {"reference": {}, "forecast": {}},
+        "levels": {"districts": {"forecast": {"03451": {"startYear": 2016, "usages": []}}}},
+    }
+    return {
+        "results": [
+            {"partials": partials, "accumulations": accumulations},
+            {"partials": [], "accumulations": {}},
+        ]
+    }
+
+
+def _decode(reply: bytes, encoding: enums.ContentEncoding) -> bytes:
+    if encoding is enums.ContentEncoding.GZIP:
+        return gzip.decompress(reply)
+    return zstandard.ZstdDecompressor().decompressobj().decompress(reply)
+
+
+@pytest.mark.parametrize("encoding", [enums.ContentEncoding.GZIP, enums.ContentEncoding.ZSTD])
+@pytest.mark.parametrize("partial_count", [0, 1, 500])
+def test_compressed_replies_match_the_plain_serialization(encoding, partial_count):
+    reply = _reply(partial_count)
+    expected = ujson.dumps(reply, ensure_ascii=False).encode("utf-8")
+    compressed_reply = serialization.dump_reply(reply, encoding, 0)
+    assert not compressed_reply.startswith(b"{")
+    assert _decode(compressed_reply, encoding) == expected
+
+
+@pytest.mark.parametrize("encoding", list(enums.ContentEncoding))
+def test_replies_below_the_threshold_are_not_compressed(encoding):
+    reply = _reply(3)
+    expected = ujson.dumps(reply, ensure_ascii=False).encode("utf-8")
+    assert serialization.dump_reply(reply, encoding, len(expected) + 1) == expected
+
+
+def test_chunks_do_not_grow_with_the_number_of_partials():
+    few_chunks = list(serialization._iterate_chunks(_reply(10)))
+    many_chunks = list(serialization._iterate_chunks(_reply(1000)))
+    assert max(len(chunk) for chunk in many_chunks) < 2 * max(len(chunk) for chunk in few_chunks)
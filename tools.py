@@ -3,6 +3,7 @@ import asyncio
 import logging
 import time
 
+import sqlalchemy
 from sqlalchemy import select
 
 import database
@@ -44,65 +45,40 @@ async def is_host_available(host: str, port: int, timeout: int = 10) -> bool:
     return False
 
 
-def get_municipal_names_from_query(municipal_ids):
-    municipal_name_query = select(
+def get_area_names(area_keys):
+    area_name_query = select(
         [
             database.tables.shapes.c.name,
             database.tables.shapes.c.key,
             database.tables.shapes.c.nuts_key,
         ],
-        database.tables.shapes.c.key.in_(municipal_ids),
-    )
-    result = database.engine.execute(municipal_name_query).all()
+        sqlalchemy.or_(
+            database.tables.shapes.c.key.in_(area_keys),
+            database.tables.shapes.c.nuts_key.in_(area_keys),
+        ),
+    ).order_by(sqlalchemy.func.length(database.tables.shapes.c.key).desc())
+    result = database.engine.execute(area_name_query).all()
     mapping = {}
     for row in result:
-        mapping.update({row[1]: (row[0], row[1], row[2])})
+        # the shortest key sharing a NUTS key is the area identified by the NUTS key
+        if row[2] in area_keys:
+            mapping.update({row[2]: row[0]})
+        if row[1] in area_keys:
+            mapping.update({row[1]: row[0]})
     return mapping
 
 
-def get_consumer_group_names_from_query(consumer_group_ids):
+def get_consumer_groups_by_identifiers(external_identifiers):
     consumer_group_parameter_query = select(
         [
             database.tables.usage_types.c.id,
             database.tables.usage_types.c.external_identifier,
             database.tables.usage_types.c.name,
         ],
-        database.tables.usage_types.c.id.in_(consumer_group_ids),
+        database.tables.usage_types.c.external_identifier.in_(external_identifiers),
     )
     result = database.engine.execute(consumer_group_parameter_query).all()
     mapping = {}
     for row in result:
         mapping.update({row[0]: (row[1], row[2])})
     return mapping
-
-
-def get_inverted_municipal_mapping(municipal_mapping: dict):
-    municipal_name_query = select(
-        [
-            database.tables.shapes.c.name,
-            database.tables.shapes.c.key,
-            database.tables.shapes.c.nuts_key,
-        ],
-        database.tables.shapes.c.key.in_(municipal_mapping.keys()),
-    )
-    result = database.engine.execute(municipal_name_query).all()
-    mapping = {}
-    for row in result:
-        mapping.update({row[1]: (row[0], row[2])})
-    return mapping
-
-
-def get_inverted_consumer_group_mapping(consumer_group: dict):
-    consumer_group_parameter_query = select(
-        [
-            database.tables.usage_types.c.id,
-            database.tables.usage_types.c.external_identifier,
-            database.tables.usage_types.c.name,
-        ],
-        database.tables.usage_types.c.id.in_(consumer_group.keys()),
-    )
-    result = database.engine.execute(consumer_group_parameter_query).all()
-    mapping = {}
-    for row in result:
-        mapping.update({row[1]: row[2]})
-    return mapping